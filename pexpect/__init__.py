@@ -80,6 +80,18 @@ try:
     import traceback
     import signal
     import codecs
+    import copy
+    import threading
+    import collections
+    import heapq
+    import mmap
+    import tempfile
+    import math
+    import socket
+    import pickle
+    import array
+    import weakref
+    import atexit
 except ImportError:  # pragma: no cover
     err = sys.exc_info()[1]
     raise ImportError(str(err) + '''
@@ -87,13 +99,27 @@ except ImportError:  # pragma: no cover
 A critical module was not found. Probably this operating system does not
 support it. Pexpect is intended for UNIX-like operating systems.''')
 
+try:
+    # Python 3.11 deprecated the old name of the regular expression parser.
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 __version__ = '3.2'
 __revision__ = ''
 __all__ = ['ExceptionPexpect', 'EOF', 'TIMEOUT', 'spawn', 'spawnu', 'run', 'runu',
-           'which', 'split_command_line', '__version__', '__revision__']
+           'which', 'which_cache', 'split_command_line', 'searcher_cache',
+           'pattern_cache', 'spill_buffer', 'spilled_output', 'select_poller',
+           'poll_poller', 'epoll_poller', 'spawn_server', 'close_all',
+           'child_reaper', 'start_reaper', 'stop_reaper', 'exit_hooks',
+           '__version__', '__revision__']
 
 PY3 = (sys.version_info[0] >= 3)
 
+# memoryview is new in Python 2.7. Without it, expect() reads through
+# read_nonblocking() instead of into an arena; see spawn._read_arena().
+_have_memoryview = sys.version_info[:2] >= (2, 7)
+
 # Exception classes used by this module.
 class ExceptionPexpect(Exception):
     '''Base class for all exceptions raised by this module.
@@ -136,7 +162,8 @@ class TIMEOUT(ExceptionPexpect):
 
 
 def run(command, timeout=-1, withexitstatus=False, events=None,
-        extra_args=None, logfile=None, cwd=None, env=None):
+        extra_args=None, logfile=None, cwd=None, env=None,
+        spill_threshold=None):
 
     '''
     This function runs the given command; waits for it to finish; then
@@ -207,10 +234,14 @@ def run(command, timeout=-1, withexitstatus=False, events=None,
     the child. 'extra_args' is not used by directly run(). It provides a way to
     pass data to a callback function through run() through the locals
     dictionary passed to a callback.
+
+    If 'spill_threshold' is set, output of more than that many bytes is
+    kept in a temporary file rather than in memory (see spill_buffer), and
+    is returned as a spilled_output instead of a string.
     '''
     return _run(command, timeout=timeout, withexitstatus=withexitstatus,
                 events=events, extra_args=extra_args, logfile=logfile, cwd=cwd,
-                env=env, _spawn=spawn)
+                env=env, _spawn=spawn, spill_threshold=spill_threshold)
 
 def runu(command, timeout=-1, withexitstatus=False, events=None,
         extra_args=None, logfile=None, cwd=None, env=None, **kwargs):
@@ -224,13 +255,16 @@ def runu(command, timeout=-1, withexitstatus=False, events=None,
                 env=env, _spawn=spawnu, **kwargs)
 
 def _run(command, timeout, withexitstatus, events, extra_args, logfile, cwd,
-         env, _spawn, **kwargs):
+         env, _spawn, spill_threshold=None, **kwargs):
     if timeout == -1:
         child = _spawn(command, maxread=2000, logfile=logfile, cwd=cwd, env=env,
                         **kwargs)
     else:
         child = _spawn(command, timeout=timeout, maxread=2000, logfile=logfile,
                 cwd=cwd, env=env, **kwargs)
+    child.spill_threshold = spill_threshold
+    # run() mostly drains output, so let reads grow past 2000 bytes.
+    child.maxread_range = (2000, 65536)
     if events is not None:
         patterns = list(events.keys())
         responses = list(events.values())
@@ -244,7 +278,8 @@ def _run(command, timeout, withexitstatus, events, extra_args, logfile, cwd,
         try:
             index = child.expect(patterns)
             if isinstance(child.after, child.allowed_string_types):
-                child_result_list.append(child.before + child.after)
+                child_result_list.append(child.before)
+                child_result_list.append(child.after)
             else:
                 # child.after may have been a TIMEOUT or EOF,
                 # which we don't want appended to the list.
@@ -267,17 +302,140 @@ def _run(command, timeout, withexitstatus, events, extra_args, logfile, cwd,
         except EOF:
             child_result_list.append(child.before)
             break
-    child_result = child.string_type().join(child_result_list)
+    if spill_threshold is None:
+        child_result = child.string_type().join(child_result_list)
+    else:
+        child_result = spill_buffer(threshold=spill_threshold,
+                                    dir=child.spill_dir)
+        for result in child_result_list:
+            child_result += result
+        child_result = child_result.view()
     if withexitstatus:
         child.close()
         return (child_result, child.exitstatus)
     else:
         return child_result
 
+class select_poller(object):
+
+    '''This waits for file descriptors to become readable using
+    select.select(). That can not watch descriptors numbered FD_SETSIZE
+    (usually 1024) or higher, so it is only the default where there is
+    neither epoll nor a working poll. See spawn.poller_type. '''
+
+    def wait(self, fds, timeout):
+
+        '''This returns the list of the descriptors in 'fds' which are ready
+        to be read, waiting at most 'timeout' seconds for one of them, or
+        forever if 'timeout' is None. '''
+
+        return select.select(fds, [], [], timeout)[0]
+
+    def close(self):
+
+        '''This releases anything the poller holds on to. '''
+
+        pass
+
+
+class poll_poller(select_poller):
+
+    '''This waits for file descriptors to become readable using
+    select.poll(), which has no limit on descriptor numbers. The descriptors
+    stay registered as long as the same ones are waited for. '''
+
+    def __init__(self):
+
+        self._poll = select.poll()
+        self._fds = ()
+
+    def wait(self, fds, timeout):
+
+        fds = tuple(fds)
+        if fds != self._fds:
+            for fd in self._fds:
+                self._poll.unregister(fd)
+            self._fds = ()
+            for fd in fds:
+                self._poll.register(fd, select.POLLIN | select.POLLPRI)
+            self._fds = fds
+        if timeout is not None:
+            # poll() takes milliseconds; round up so as not to spin.
+            timeout = int(math.ceil(max(0, timeout) * 1000))
+        # Hangups and errors count as readable, the same as for select();
+        # the read that follows reports them.
+        return [fd for fd, event in self._poll.poll(timeout)]
+
+
+class epoll_poller(select_poller):
+
+    '''This waits for file descriptors to become readable using
+    select.epoll(), which has no limit on descriptor numbers. The
+    descriptors stay registered with the kernel as long as the same ones
+    are waited for. Descriptors epoll refuses, such as regular files, are
+    waited for with a poll_poller instead.
+
+    This is not the default, as each instance holds a descriptor of its own
+    and a spawn instance only ever waits for one or two descriptors, which
+    poll() copes with just as well. '''
+
+    def __init__(self):
+
+        self._epoll = select.epoll()
+        self._fds = ()
+        self._fallback = None
+
+    def wait(self, fds, timeout):
+
+        fds = tuple(fds)
+        if self._fallback is not None:
+            return self._fallback.wait(fds, timeout)
+        if fds != self._fds:
+            for fd in self._fds:
+                try:
+                    self._epoll.unregister(fd)
+                except (IOError, OSError, ValueError):
+                    # It was closed, which unregisters it.
+                    pass
+            self._fds = ()
+            try:
+                for fd in fds:
+                    self._epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                if err.errno != errno.EPERM:
+                    raise
+                self.close()
+                self._fallback = poll_poller()
+                return self._fallback.wait(fds, timeout)
+            self._fds = fds
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = max(0, timeout)
+        return [fd for fd, event in self._epoll.poll(timeout)]
+
+    def close(self):
+
+        self._epoll.close()
+
+
+if hasattr(select, 'poll') and sys.platform != 'darwin':
+    # poll() does not work with ptys on OS X.
+    default_poller = poll_poller
+else:
+    default_poller = select_poller
+
+
 class spawn(object):
     '''This is the main class interface for Pexpect. Use this class to start
     and control child applications. '''
     string_type = bytes
+    # expect_loop() appends incoming data to one of these
+    receive_buffer_type = bytearray
+    # readline() splits lines at these
+    crlf = b'\r\n'
+    _crlf_re = re.compile(crlf)
     if PY3:
         allowed_string_types = (bytes, str)
         @staticmethod
@@ -302,7 +460,8 @@ class spawn(object):
 
     def __init__(self, command, args=[], timeout=30, maxread=2000,
         searchwindowsize=None, logfile=None, cwd=None, env=None,
-        ignore_sighup=True):
+        ignore_sighup=True, pass_fds=(), use_posix_spawn=False,
+        spawn_server=None):
 
         '''This is the constructor. The command parameter may be a string that
         includes a command and any arguments to the command. For example::
@@ -344,6 +503,17 @@ class spawn(object):
         output are read back from the child. This feature is useful in
         conjunction with searchwindowsize.
 
+        To have expect() pick the read size, set the maxread_range attribute
+        to a (smallest, largest) tuple. maxread is then doubled whenever a
+        read fills it, up to the largest size, and halved whenever a read
+        uses less than an eighth of it, down to the smallest size. The
+        maxread attribute always shows the size currently in use.
+
+        When output comes in bursts, set the drain_limit attribute to a
+        number of bytes. After each read, expect() then goes on reading,
+        without waiting, until there is nothing more waiting or it has that
+        much, and searches all of it at once.
+
         The searchwindowsize attribute sets the how far back in the incoming
         seach buffer Pexpect will search for pattern matches. Every time
         Pexpect reads some data from the child it will append the data to the
@@ -354,6 +524,21 @@ class spawn(object):
         affect the size of the incoming data buffer. You will still have
         access to the full buffer after expect() returns.
 
+        If the output is too big to hold in memory, set the spill_threshold
+        attribute to a number of bytes. The incoming buffer is then moved to
+        a temporary file in spill_dir once it grows past that size, and
+        'before' and 'buffer' are spilled_output views of that file rather
+        than strings when they are bigger than that. This does not work with
+        spawnu, where expect() raises ExceptionPexpect if it is set.
+
+        To bound memory use instead, set the maxbuffer attribute. Once there
+        are more than that many bytes of unmatched data, the oldest are
+        thrown away after they have been searched, so a match has to fit in
+        the last maxbuffer bytes. The maxbefore attribute
+        likewise keeps only the end of 'before'. The number of bytes thrown
+        away either way is added up in the discarded attribute. maxbuffer
+        is ignored while spill_threshold is set.
+
         The logfile member turns on or off logging. All input and output will
         be copied to the given file object. Set logfile to None to stop
         logging. This is the default. Set logfile to sys.stdout to echo
@@ -387,6 +572,23 @@ class spawn(object):
         earlier versions of Pexpect, but you should pass this explicitly if you
         want to rely on it.
 
+        The child does not inherit any file descriptors from the parent other
+        than the pty, which becomes its stdin, stdout and stderr. To give it
+        others, list them in ``pass_fds``, as for :class:`subprocess.Popen`.
+
+        Normally the child is started with fork(), and a little Python code
+        runs in it to set up the pty before exec. If ``use_posix_spawn`` is
+        True, and the system has os.posix_spawn() (Linux with Python 3.8 or
+        later), the pty is set up in the parent instead and the child is
+        started with posix_spawn(), whose cost does not grow with the size of
+        the parent process. If the child has to ignore SIGHUP or change to
+        ``cwd``, it does so in a /bin/sh helper that then execs the command.
+        Descriptors in ``pass_fds`` are made inheritable in the parent.
+
+        If ``spawn_server`` is a :class:`spawn_server`, that process starts
+        the child instead, and passes the pty back. The spawn object works as
+        usual, except that the child is not a child of this process.
+
         The delaybeforesend helps overcome a weird behavior that many users
         were experiencing. The typical problem was that a user would expect() a
         "Password:" prompt and then immediately call sendline() to send the
@@ -415,7 +617,9 @@ class spawn(object):
         signalstatus will store the signal value and exitstatus will be None.
         If you need more detail you can also read the self.status member which
         stores the status returned by os.waitpid. You can interpret this using
-        os.WIFEXITED/os.WEXITSTATUS or os.WIFSIGNALED/os.TERMSIG. '''
+        os.WIFEXITED/os.WEXITSTATUS or os.WIFSIGNALED/os.TERMSIG. Where
+        os.wait4 is available the resource usage of the child is stored in
+        self.rusage as well; see resource_usage() and exit_hooks. '''
 
         self.STDIN_FILENO = pty.STDIN_FILENO
         self.STDOUT_FILENO = pty.STDOUT_FILENO
@@ -426,6 +630,40 @@ class spawn(object):
 
         self.searcher = None
         self.ignorecase = False
+        # Have expect() search for all its patterns in a single pass, see
+        # searcher_re.
+        self.combine_patterns = False
+        # Keep at most this many bytes of output in memory, see spill_buffer.
+        self.spill_threshold = None
+        # The directory for the temporary file, the default if None.
+        self.spill_dir = None
+        # Keep at most this much unmatched data, and at most this much of
+        # it in 'before'. Anything else counts towards discarded.
+        self.maxbuffer = None
+        self.maxbefore = None
+        self.discarded = 0
+        # What waits for the child to have data to read; see select_poller.
+        self.poller_type = default_poller
+        self._poller = None
+        # On Linux, a descriptor that becomes readable when the child exits;
+        # see isalive().
+        self._pidfd = None
+        self._pidfd_poll = None
+        self._pidfd_ready = False
+        # The child_reaper collecting the exit status of the child, if any.
+        self._reaper = None
+        # What _abandon_child() needs to know should this be garbage
+        # collected without being closed, and the weakref.finalize calling it.
+        # Only plain values go in here: anything referring back to self
+        # would keep it alive for good.
+        self._orphan = {'pid': None, 'child_fd': None, 'pidfd': None,
+                        'terminated': True, 'own_child': True,
+                        'reaper': None}
+        self._finalizer = None
+        # expect() reads into this, see read_nonblocking_into().
+        self._arena = None
+        # How many strings of data read from the child were allocated.
+        self.read_allocations = 0
         self.before = None
         self.after = None
         self.match = None
@@ -435,6 +673,11 @@ class spawn(object):
         self.signalstatus = None
         # status returned by os.waitpid
         self.status = None
+        # resource usage of the child returned by os.wait4, once it exits
+        self.rusage = None
+        # time.time() when the child was started, and its exit noticed
+        self.start_time = None
+        self._exit_time = None
         self.flag_eof = False
         self.pid = None
         # the chile filedescriptor is initially closed
@@ -448,18 +691,22 @@ class spawn(object):
         self.logfile_send = None
         # max bytes to read at one time into buffer
         self.maxread = maxread
+        # (smallest, largest) to let expect() adjust maxread, or None.
+        self.maxread_range = None
+        # Read up to this many bytes that are already waiting before
+        # searching them, or None to search after every read.
+        self.drain_limit = None
         # This is the read buffer. See maxread.
         self.buffer = self.string_type()
+        # How much of the start of _buffer has been handed out by
+        # _iter_lines() without slicing it off yet, see buffer.
+        self._buffer_start = 0
         # Data before searchwindowsize point is preserved, but not searched.
         self.searchwindowsize = searchwindowsize
         # Delay used before sending data to child. Time in seconds.
         # Most Linux machines don't like this to be below 0.03 (30 ms).
         self.delaybeforesend = 0.05
-        # Used by close() to give kernel time to update process status.
-        # Time in seconds.
         self.delayafterclose = 0.1
-        # Used by terminate() to give kernel time to update process status.
-        # Time in seconds.
         self.delayafterterminate = 0.1
         self.softspace = False
         self.name = '<' + repr(self) + '>'
@@ -467,14 +714,22 @@ class spawn(object):
         self.cwd = cwd
         self.env = env
         self.ignore_sighup = ignore_sighup
+        self.pass_fds = tuple(sorted(set(pass_fds)))
         # This flags if we are running on irix
         self.__irix_hack = (sys.platform.lower().find('irix') >= 0)
+        solaris = ((sys.platform.lower().find('solaris') >= 0)
+            or (sys.platform.lower().find('sunos5') >= 0))
         # Solaris uses internal __fork_pty(). All others use pty.fork().
-        if ((sys.platform.lower().find('solaris') >= 0)
-            or (sys.platform.lower().find('sunos5') >= 0)):
-            self.use_native_pty_fork = False
-        else:
-            self.use_native_pty_fork = True
+        self.use_native_pty_fork = not solaris
+        # Use __posix_spawn_pty() instead of forking, where it works.
+        self.use_posix_spawn = use_posix_spawn and _can_posix_spawn
+        # Ask this spawn_server to start the child, if it is not None.
+        self.spawn_server = spawn_server
+        # Solaris and Irix do not give an EOF when the child dies, so on those
+        # read_nonblocking() has to check that the child is alive before
+        # waiting for data. Elsewhere it only checks when the read fails or
+        # the wait times out.
+        self.__check_alive_before_read = solaris or self.__irix_hack
 
         # Support subclasses that do not use command or args.
         if command is None:
@@ -505,9 +760,13 @@ class spawn(object):
         garbage collects Python objects. OS file descriptors are not Python
         objects, so they must be handled explicitly. If the child file
         descriptor was opened outside of this class (passed to the constructor)
-        then this does not close it. '''
+        then this does not close it.
 
-        if not self.closed:
+        A child started by this class is left to its weakref.finalize
+        instead, where there is one (Python 3.4 or later), so that dropping
+        the object never waits for the child; see _abandon_child(). '''
+
+        if not self.closed and self._finalizer is None:
             # It is possible for __del__ methods to execute during the
             # teardown of the Python VM itself. Thus self.close() may
             # trigger an exception because os.close may be None.
@@ -517,6 +776,49 @@ class spawn(object):
             except:
                 pass
 
+    @property
+    def delayafterclose(self):
+
+        '''Used by close() to give the child time to exit before terminate().
+        The longest it waits, in seconds. '''
+
+        return self._orphan['delayafterclose']
+
+    @delayafterclose.setter
+    def delayafterclose(self, value):
+
+        self._orphan['delayafterclose'] = value
+
+    @property
+    def delayafterterminate(self):
+
+        '''Used by terminate() to give the child time to exit after each
+        signal. The longest it waits, in seconds. '''
+
+        return self._orphan['delayafterterminate']
+
+    @delayafterterminate.setter
+    def delayafterterminate(self, value):
+
+        self._orphan['delayafterterminate'] = value
+
+    @property
+    def buffer(self):
+
+        '''The data read from the child that has not been matched or handed
+        out yet. '''
+
+        if self._buffer_start:
+            self._buffer = self._buffer[self._buffer_start:]
+            self._buffer_start = 0
+        return self._buffer
+
+    @buffer.setter
+    def buffer(self, value):
+
+        self._buffer = value
+        self._buffer_start = 0
+
     def __str__(self):
         '''This returns a human-readable string that represents the state of
         the object. '''
@@ -584,7 +886,7 @@ class spawn(object):
             self.args.insert(0, command)
             self.command = command
 
-        command_with_path = which(self.command)
+        command_with_path = _cached_which(self.command)
         if command_with_path is None:
             raise ExceptionPexpect('The command was not found or was not ' +
                     'executable: %s.' % self.command)
@@ -596,7 +898,13 @@ class spawn(object):
         assert self.pid is None, 'The pid member must be None.'
         assert self.command is not None, 'The command member must not be None.'
 
-        if self.use_native_pty_fork:
+        self.start_time = time.time()
+        exit_fd = None
+        if self.spawn_server is not None:
+            self.pid, self.child_fd, exit_fd = self.spawn_server._start(self)
+        elif self.use_posix_spawn:
+            self.pid, self.child_fd = self.__posix_spawn_pty()
+        elif self.use_native_pty_fork:
             try:
                 self.pid, self.child_fd = pty.fork()
             except OSError:
@@ -619,27 +927,99 @@ class spawn(object):
                 # are very picky about window size.
                 # This is a serious limitation, but not a show stopper.
                 pass
-            # Do not allow child to inherit open file descriptors from parent.
-            max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
-            for i in range(3, max_fd):
-                try:
-                    os.close(i)
-                except OSError:
-                    pass
-
-            if self.ignore_sighup:
-                signal.signal(signal.SIGHUP, signal.SIG_IGN)
-
-            if self.cwd is not None:
-                os.chdir(self.cwd)
-            if self.env is None:
-                os.execv(self.command, self.args)
-            else:
-                os.execvpe(self.command, self.args, self.env)
+            _exec_child(self.command, self.args, self.env, self.cwd,
+                        self.ignore_sighup, self.pass_fds)
 
         # Parent
         self.terminated = False
         self.closed = False
+        self._open_pidfd(exit_fd)
+        if _reaper is not None and self.spawn_server is None:
+            self._reaper = _reaper
+            self._reaper.register(self.pid, self._pidfd)
+        if hasattr(weakref, 'finalize'):
+            self._orphan.update(pid=self.pid, child_fd=self.child_fd,
+                                pidfd=self._pidfd, terminated=False,
+                                own_child=self.spawn_server is None,
+                                reaper=self._reaper)
+            self._finalizer = weakref.finalize(self, _abandon_child,
+                                               self._orphan)
+            # _finish_orphans() calls it at exit instead.
+            self._finalizer.atexit = False
+            _finalizers[id(self._orphan)] = self._finalizer
+
+    def _open_pidfd(self, fd=None):
+
+        '''This opens a pidfd for the child where the system has them (Linux
+        5.3 and Python 3.9 or later). It becomes readable once the child has
+        exited, so isalive() only has to call waitpid() once it is, and
+        read_nonblocking() notices the exit while it waits. Where there is no
+        pidfd, isalive() polls with waitpid() as before. For a child started
+        by a spawn_server, 'fd' is the socket the server sends its wait
+        status to, which is used the same way. '''
+
+        self._pidfd_poll = None
+        self._pidfd_ready = False
+        self._pidfd = fd
+        if fd is not None or not hasattr(os, 'pidfd_open'):
+            return
+        try:
+            self._pidfd = os.pidfd_open(self.pid)
+        except OSError:
+            # ENOSYS on older kernels, or the pid is not a process we can
+            # open. Either way waitpid() still works.
+            pass
+
+    def _close_pidfd(self):
+
+        '''This closes the pidfd once it is no longer needed. '''
+
+        if self._pidfd is not None:
+            fd, self._pidfd = self._pidfd, None
+            self._pidfd_poll = None
+            self._orphan['pidfd'] = None
+            if self._reaper is not None:
+                # The reaper may still be watching it.
+                self._reaper.release(self.pid, fd)
+                return
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _pidfd_readable(self, timeout=0):
+
+        '''This returns True if the pidfd says that the child has exited,
+        waiting up to 'timeout' seconds for it to. Once it has, the answer is
+        remembered. '''
+
+        if not self._pidfd_ready:
+            if self._pidfd_poll is None:
+                self._pidfd_poll = select.poll()
+                self._pidfd_poll.register(self._pidfd, select.POLLIN)
+            # poll() takes milliseconds; round up so as not to spin.
+            if self._pidfd_poll.poll(int(math.ceil(timeout * 1000))):
+                self._pidfd_ready = True
+        return self._pidfd_ready
+
+    def _wait_exit(self, timeout):
+
+        '''This waits up to 'timeout' seconds for the child to exit, and
+        returns True if it has. It waits on the pidfd where there is one, or
+        else calls isalive() at growing intervals. '''
+
+        end_time = time.time() + timeout
+        delay = 0.001
+        while self.isalive():
+            timeout = end_time - time.time()
+            if timeout <= 0:
+                return False
+            if self._pidfd is not None and not self._pidfd_ready:
+                self._pidfd_readable(timeout)
+            else:
+                time.sleep(min(delay, timeout))
+                delay = delay * 2
+        return True
 
     def __fork_pty(self):
         '''This implements a substitute for the forkpty system call. This
@@ -679,6 +1059,67 @@ class spawn(object):
 
         return pid, parent_fd
 
+    def __posix_spawn_pty(self):
+        '''This starts the child with os.posix_spawn(), so no Python code
+        runs in it. The pty is opened and sized in the parent. The child
+        starts a new session and opens the pty by name, which on Linux makes
+        it the controlling tty, as its stdin, stdout and stderr. '''
+
+        parent_fd, child_fd = os.openpty()
+        try:
+            child_name = os.ttyname(child_fd)
+            self.child_fd = parent_fd
+            try:
+                self.setwinsize(24, 80)
+            except (IOError, OSError):
+                # See _spawn() for why this does not matter much.
+                pass
+
+            # The child only gets the descriptors that are inheritable, but
+            # that is put back as it was afterwards, so they do not leak
+            # into whatever else this process starts.
+            made_inheritable = [fd for fd in self.pass_fds
+                                if not os.get_inheritable(fd)]
+            try:
+                for fd in made_inheritable:
+                    os.set_inheritable(fd, True)
+                # Descriptors Python opens are closed on exec anyway, so this
+                # only closes those that something else left inheritable.
+                file_actions = [(os.POSIX_SPAWN_CLOSE, fd)
+                                for fd in _inherited_fds(self.pass_fds)]
+                file_actions += [
+                    (os.POSIX_SPAWN_OPEN, 0, child_name, os.O_RDWR, 0),
+                    (os.POSIX_SPAWN_DUP2, 0, 1),
+                    (os.POSIX_SPAWN_DUP2, 0, 2),
+                ]
+
+                argv = self.args
+                script = []
+                if self.ignore_sighup:
+                    # An ignored signal stays ignored across exec.
+                    script.append('trap "" HUP')
+                if self.cwd is not None:
+                    script.append('cd "$0" || exit 127')
+                if script:
+                    script.append('exec "$@"')
+                    argv = (['/bin/sh', '-c', '; '.join(script),
+                             self.cwd or 'sh'] + argv)
+                env = self.env
+                if env is None:
+                    env = os.environ
+                pid = os.posix_spawn(argv[0], argv, env,
+                                     file_actions=file_actions, setsid=True)
+            finally:
+                for fd in made_inheritable:
+                    os.set_inheritable(fd, False)
+        except:
+            os.close(parent_fd)
+            raise
+        finally:
+            os.close(child_fd)
+
+        return pid, parent_fd
+
     def __pty_make_controlling_tty(self, tty_fd):
         '''This makes the pseudo-terminal the controlling tty. This should be
         more portable than the pty.fork() function. Specifically, this should
@@ -736,17 +1177,41 @@ class spawn(object):
         and SIGINT). '''
 
         if not self.closed:
-            self.flush()
-            os.close(self.child_fd)
-            # Give kernel time to update process status.
-            time.sleep(self.delayafterclose)
-            if self.isalive():
+            self._close_pty()
+            # Give the child up to delayafterclose to exit on its own.
+            if not self._wait_exit(self.delayafterclose):
                 if not self.terminate(force):
                     raise ExceptionPexpect('Could not terminate the child.')
-            self.child_fd = -1
-            self.closed = True
+            self._close_pidfd()
             #self.pid = None
 
+    def _close_pty(self):
+
+        '''This closes the pty, and the poller waiting on it, but leaves the
+        child alone. It is the first step of close(), and of close_all().
+        From here on, whatever closes the instance sees to the child, so the
+        weakref.finalize is no longer needed. '''
+
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
+            _finalizers.pop(id(self._orphan), None)
+        self._orphan['child_fd'] = None
+        self.flush()
+        os.close(self.child_fd)
+        self.child_fd = -1
+        self.closed = True
+        self._close_poller()
+
+    def _close_poller(self):
+
+        '''This releases the poller, which may hold on to a descriptor of its
+        own, once child_fd is closed. '''
+
+        if self._poller is not None:
+            self._poller.close()
+            self._poller = None
+
     def flush(self):
         '''This does nothing. It is here to support the interface for a
         File-like object. '''
@@ -867,8 +1332,67 @@ class spawn(object):
         available right away then one character will be returned immediately.
         It will not wait for 30 seconds for another 99 characters to come in.
 
-        This is a wrapper around os.read(). It uses select.select() to
-        implement the timeout. '''
+        This is a wrapper around os.read(). It uses the poller_type attribute,
+        poll where available, to implement the timeout. '''
+
+        self._wait_readable(timeout)
+        try:
+            s = os.read(self.child_fd, size)
+        except OSError:
+            # Linux does this
+            self.flag_eof = True
+            raise EOF('End Of File (EOF). Exception style platform.')
+        if s == b'':
+            # BSD style
+            self.flag_eof = True
+            raise EOF('End Of File (EOF). Empty string style platform.')
+        self.read_allocations += 1
+
+        s = self._coerce_read_string(s)
+        self._log(s, 'read')
+        return s
+
+    def read_nonblocking_into(self, buffer, timeout=-1):
+
+        '''This is read_nonblocking() for a preallocated 'buffer', such as a
+        bytearray or a writable memoryview. It reads at most len(buffer) bytes
+        into it and returns how many it read. The bytes are not decoded, not
+        even by spawnu. Timeouts and EOF are as for read_nonblocking().
+
+        expect() reads this way into an arena of maxread bytes which is
+        allocated once, rather than allocate a new string for every read. '''
+
+        self._wait_readable(timeout)
+        try:
+            n = self._readinto(buffer)
+        except OSError:
+            # Linux does this
+            self.flag_eof = True
+            raise EOF('End Of File (EOF). Exception style platform.')
+        if n == 0:
+            # BSD style
+            self.flag_eof = True
+            raise EOF('End Of File (EOF). Empty string style platform.')
+
+        if (self.logfile is not None or self.logfile_read is not None):
+            self._log(bytes(memoryview(buffer)[:n]), 'read')
+        return n
+
+    def _readinto(self, buffer):
+
+        '''This reads from child_fd straight into 'buffer' where os.readv()
+        is available, and returns how many bytes it read. '''
+
+        if hasattr(os, 'readv'):
+            return os.readv(self.child_fd, [buffer])
+        s = os.read(self.child_fd, len(buffer))
+        buffer[:len(s)] = s
+        return len(s)
+
+    def _wait_readable(self, timeout):
+
+        '''This waits until child_fd can be read for read_nonblocking(), or
+        raises EOF or TIMEOUT. '''
 
         if self.closed:
             raise ValueError('I/O operation on closed file.')
@@ -881,9 +1405,11 @@ class spawn(object):
         # from the child_fd -- it will block forever or until TIMEOUT.
         # For this case, I test isalive() before doing any reading.
         # If isalive() is false, then I pretend that this is the same as EOF.
-        if not self.isalive():
+        # Other platforms report EOF or EIO from os.read() below, so they are
+        # spared the waitpid() call on every read.
+        if self.__check_alive_before_read and not self.isalive():
             # timeout of 0 means "poll"
-            r, w, e = self.__select([self.child_fd], [], [], 0)
+            r = self.__select([self.child_fd], 0)
             if not r:
                 self.flag_eof = True
                 raise EOF('End Of File (EOF). Braindead platform.')
@@ -891,12 +1417,38 @@ class spawn(object):
             # Irix takes a long time before it realizes a child was terminated.
             # FIXME So does this mean Irix systems are forced to always have
             # FIXME a 2 second delay when calling read_nonblocking? That sucks.
-            r, w, e = self.__select([self.child_fd], [], [], 2)
+            r = self.__select([self.child_fd], 2)
             if not r and not self.isalive():
                 self.flag_eof = True
                 raise EOF('End Of File (EOF). Slow platform.')
 
-        r, w, e = self.__select([self.child_fd], [], [], timeout)
+        # A child that has exited while something it started still holds the
+        # pty open gives no EOF on the pty, so it is reported here once there
+        # is nothing left to read. The pidfd tells for free; without one,
+        # isalive() is only asked when there is nothing to read anyway.
+        exited = self.terminated or self._pidfd_ready
+        if (not exited and self._pidfd is None and
+                not self.__check_alive_before_read and
+                not self.__select([self.child_fd], 0)):
+            exited = not self.isalive()
+        if exited and not self.__select([self.child_fd], 0):
+            self.flag_eof = True
+            raise EOF('End Of File (EOF). The child has exited.')
+
+        fds = [self.child_fd]
+        if self._pidfd is not None and not self._pidfd_ready:
+            # Wait for the child to exit at the same time, so that isalive()
+            # does not need to ask.
+            fds.append(self._pidfd)
+        r = self.__select(fds, timeout)
+        if self._pidfd is not None and self._pidfd in r:
+            self._pidfd_ready = True
+            if self.child_fd not in r:
+                # The child exited while waiting, so as above.
+                r = self.__select([self.child_fd], 0)
+                if not r:
+                    self.flag_eof = True
+                    raise EOF('End Of File (EOF). The child has exited.')
 
         if not r:
             if not self.isalive():
@@ -908,30 +1460,19 @@ class spawn(object):
             else:
                 raise TIMEOUT('Timeout exceeded.')
 
-        if self.child_fd in r:
-            try:
-                s = os.read(self.child_fd, size)
-            except OSError:
-                # Linux does this
-                self.flag_eof = True
-                raise EOF('End Of File (EOF). Exception style platform.')
-            if s == b'':
-                # BSD style
-                self.flag_eof = True
-                raise EOF('End Of File (EOF). Empty string style platform.')
-
-            s = self._coerce_read_string(s)
-            self._log(s, 'read')
-            return s
-
-        raise ExceptionPexpect('Reached an unexpected state.')
+        if self.child_fd not in r:
+            raise ExceptionPexpect('Reached an unexpected state.')
 
     def read(self, size=-1):
         '''This reads at most "size" bytes from the file (less if the read hits
         EOF before obtaining size bytes). If the size argument is negative or
         omitted, read all data until EOF is reached. The bytes are returned as
         a string object. An empty string is returned when EOF is encountered
-        immediately. '''
+        immediately.
+
+        Either way reading also stops at 'delimiter', which is EOF unless it
+        was set to something else. When 'size' bytes are read, 'match' is
+        the same as 'after', those bytes, rather than a match object. '''
 
         if size == 0:
             return self.string_type()
@@ -940,21 +1481,46 @@ class spawn(object):
             self.expect(self.delimiter)
             return self.before
 
-        # I could have done this more directly by not using expect(), but
-        # I deliberately decided to couple read() to expect() so that
-        # I would catch any bugs early and ensure consistant behavior.
-        # It's a little less efficient, but there is less for me to
-        # worry about if I have to later modify read() or expect().
-        # Note, it's OK if size==-1 in the regex. That just means it
-        # will never match anything in which case we stop only on EOF.
-        cre = re.compile(self._coerce_expect_string('.{%d}' % size), re.DOTALL)
-        # delimiter default is EOF
-        index = self.expect([cre, self.delimiter])
+        # This still goes through expect_loop(), so timeouts, EOF and the
+        # before/after attributes work the same as for expect(), but the
+        # searcher only has to count.
+        if self.delimiter is EOF:
+            searcher = searcher_count(size, eof=True)
+        else:
+            delimiter = searcher_re(self.compile_pattern_list(self.delimiter))
+            searcher = searcher_count(size, delimiter=delimiter)
+        index = self.expect_loop(searcher)
         if index == 0:
-            ### FIXME self.before should be ''. Should I assert this?
+            self.match = self.after
             return self.after
         return self.before
 
+    def read_exactly(self, size, timeout=-1):
+
+        '''This reads and returns exactly 'size' bytes, or characters for
+        spawnu. Unlike read() this raises EOF if the child closes its output
+        first, with what was read so far in 'before', and TIMEOUT if the
+        data does not arrive within 'timeout' seconds. If timeout==-1 then
+        the self.timeout value is used. '''
+
+        if size <= 0:
+            return self.string_type()
+        self.expect_loop(searcher_count(size), timeout)
+        self.match = self.after
+        return self.after
+
+    def readinto(self, buffer):
+
+        '''This reads up to len(buffer) bytes into 'buffer', which may be a
+        bytearray or a writable memoryview of bytes, the same as read() would
+        return them. This returns the number of bytes read, which is 0 at
+        EOF. '''
+
+        view = memoryview(buffer)
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
     def readline(self, size=-1):
         '''This reads and returns one entire line. The newline at the end of
         line is returned as part of the string, unless the file ends without a
@@ -969,17 +1535,83 @@ class spawn(object):
 
         if size == 0:
             return self.string_type()
+        return self._readline()
+
+    def _readline(self, timeout=-1):
+
+        '''This is readline(). A line which is already complete in the buffer
+        is split off without going through expect(), unless 'delimiter' is a
+        pattern, which could match before the newline. Either way 'before' is
+        the line without its newline, 'after' is the newline and 'match' is
+        its match object, as expect() leaves them. '''
+
+        crlf = self.crlf
+        buffer = self.buffer
+        if (self._delimiter_is_eof() and
+                not isinstance(buffer, spilled_output)):
+            match = self._crlf_re.search(buffer)
+            if match is not None:
+                end = match.end()
+                self.before = buffer[:match.start()]
+                self.after = crlf
+                self.match = match
+                self.match_index = 0
+                self.buffer = buffer[end:]
+                return buffer[:end]
         # delimiter default is EOF
-        index = self.expect([b'\r\n', self.delimiter])
+        index = self.expect([self._crlf_re, self.delimiter], timeout)
         if index == 0:
-            return self.before + b'\r\n'
+            return self.before + crlf
         else:
             return self.before
 
+    def _iter_lines(self, timeout=-1):
+
+        '''This generates the lines that readline() would return, until EOF.
+        Each chunk read from the child is split into all of its complete
+        lines at once; they are then handed out one at a time, and the
+        buffer always holds what has not been handed out yet, so readline()
+        or expect() can take over at any point.
+
+        Rather than slicing each line off the buffer, which would copy the
+        rest of the chunk every time, this only moves _buffer_start past it;
+        the buffer property slices it off once something looks at it. '''
+
+        crlf = self.crlf
+        while True:
+            line = self._readline(timeout)
+            if not line:
+                return
+            yield line
+            data = self.buffer
+            if (not self._delimiter_is_eof() or
+                    isinstance(data, spilled_output)):
+                continue
+            start = 0
+            for match in self._crlf_re.finditer(data):
+                end = match.end()
+                self.before = data[start:match.start()]
+                self.after = crlf
+                self.match = match
+                self.match_index = 0
+                self._buffer_start = end
+                yield data[start:end]
+                if self._buffer is not data:
+                    # Something else has read from the buffer meanwhile.
+                    break
+                start = end
+
+    def _delimiter_is_eof(self):
+
+        '''This tells whether 'delimiter' is EOF or TIMEOUT rather than a
+        pattern, so that a line ends only at a newline. '''
+
+        return self.delimiter is EOF or self.delimiter is TIMEOUT
+
     def __iter__(self):
         '''This is to support iterators over a file-like object.
         '''
-        return iter(self.readline, self.string_type())
+        return self._iter_lines()
 
     def readlines(self, sizehint=-1):
         '''This reads until EOF using readline() and returns a list containing
@@ -989,13 +1621,7 @@ class spawn(object):
         a child that is still running with its stdout open then this
         method will block until it timesout.'''
 
-        lines = []
-        while True:
-            line = self.readline()
-            if not line:
-                break
-            lines.append(line)
-        return lines
+        return list(self._iter_lines())
 
     def write(self, s):
         '''This is similar to send() except that there is no return value.
@@ -1120,41 +1746,32 @@ class spawn(object):
         '''This forces a child process to terminate. It starts nicely with
         SIGHUP and SIGINT. If "force" is True then moves onto SIGKILL. This
         returns True if the child was terminated. This returns False if the
-        child could not be terminated. '''
+        child could not be terminated. After each signal this waits up to
+        delayafterterminate seconds for the child to exit, but no longer
+        than it takes to. '''
 
         if not self.isalive():
             return True
         try:
             self.kill(signal.SIGHUP)
-            time.sleep(self.delayafterterminate)
-            if not self.isalive():
+            if self._wait_exit(self.delayafterterminate):
                 return True
             self.kill(signal.SIGCONT)
-            time.sleep(self.delayafterterminate)
-            if not self.isalive():
+            if self._wait_exit(self.delayafterterminate):
                 return True
             self.kill(signal.SIGINT)
-            time.sleep(self.delayafterterminate)
-            if not self.isalive():
+            if self._wait_exit(self.delayafterterminate):
                 return True
             if force:
                 self.kill(signal.SIGKILL)
-                time.sleep(self.delayafterterminate)
-                if not self.isalive():
-                    return True
-                else:
-                    return False
+                return self._wait_exit(self.delayafterterminate)
             return False
         except OSError:
             # I think there are kernel timing issues that sometimes cause
             # this to happen. I think isalive() reports True, but the
             # process is dead to the kernel.
             # Make one last attempt to see if the kernel is up to date.
-            time.sleep(self.delayafterterminate)
-            if not self.isalive():
-                return True
-            else:
-                return False
+            return self._wait_exit(self.delayafterterminate)
 
     def wait(self):
 
@@ -1164,10 +1781,18 @@ class spawn(object):
         may have printed output then called exit(), but, the child is
         technically still alive until its output is read by the parent. '''
 
-        if self.isalive():
-            pid, status = os.waitpid(self.pid, 0)
-        else:
+        if not self.isalive():
             raise ExceptionPexpect('Cannot wait for dead child process.')
+        elif self._reaper is not None:
+            self._reaper.wait(self.pid)
+            if not self.isalive():
+                return self.exitstatus
+            pid, status, rusage = _wait4(self.pid, 0)
+        elif self.spawn_server is not None:
+            status, rusage = _read_exit_status(self._pidfd)
+        else:
+            pid, status, rusage = _wait4(self.pid, 0)
+        self.rusage = rusage
         self.exitstatus = os.WEXITSTATUS(status)
         if os.WIFEXITED(status):
             self.status = status
@@ -1184,6 +1809,7 @@ class spawn(object):
             raise ExceptionPexpect('Called wait() on a stopped child ' +
                     'process. This is not supported. Is some other ' +
                     'process attempting job control with our child pid?')
+        self._report_exit()
         return self.exitstatus
 
     def isalive(self):
@@ -1197,17 +1823,58 @@ class spawn(object):
         if self.terminated:
             return False
 
+        if self.spawn_server is not None:
+            # There is no waitpid() for a child of the server, which sends the
+            # wait status instead once the child exits. After EOF, wait for it.
+            if not self.flag_eof and not self._pidfd_readable():
+                return True
+            self.__set_status(*_read_exit_status(self._pidfd))
+            self._close_pidfd()
+            return False
+
+        if self._reaper is not None:
+            # The reaper keeps the exit status once it has the child, so this
+            # costs a dictionary lookup. It is only waited for when the child
+            # is known to have exited.
+            reaper = self._reaper
+            result = reaper.status(self.pid)
+            if result is None and reaper.running:
+                if not self.flag_eof and not self._pidfd_ready:
+                    return True
+                result = reaper.wait(self.pid)
+            if result is not None:
+                reaper.forget(self.pid)
+                self._reaper = None
+                status, rusage = result
+                if status is None:
+                    # Somebody else reaped the child, so how it exited is
+                    # not known.
+                    self.terminated = True
+                    self._report_exit()
+                else:
+                    self.__set_status(status, rusage)
+                self._close_pidfd()
+                return False
+            # The reaper was stopped before the child exited.
+            self._reaper = None
+
         if self.flag_eof:
             # This is for Linux, which requires the blocking form
             # of waitpid to # get status of a defunct process.
             # This is super-lame. The flag_eof would have been set
             # in read_nonblocking(), so this should be safe.
             waitpid_options = 0
+        elif self._pidfd is not None:
+            # The pidfd is readable once the child has exited, and then the
+            # blocking waitpid returns at once.
+            if not self._pidfd_readable():
+                return True
+            waitpid_options = 0
         else:
             waitpid_options = os.WNOHANG
 
         try:
-            pid, status = os.waitpid(self.pid, waitpid_options)
+            pid, status, rusage = _wait4(self.pid, waitpid_options)
         except OSError:
             err = sys.exc_info()[1]
             # No child processes
@@ -1226,7 +1893,7 @@ class spawn(object):
         if pid == 0:
             try:
                 ### os.WNOHANG) # Solaris!
-                pid, status = os.waitpid(self.pid, waitpid_options)
+                pid, status, rusage = _wait4(self.pid, waitpid_options)
             except OSError as e:
                 # This should never happen...
                 if e.errno == errno.ECHILD:
@@ -1248,6 +1915,16 @@ class spawn(object):
         if pid == 0:
             return True
 
+        self.__set_status(status, rusage)
+        self._close_pidfd()
+        return False
+
+    def __set_status(self, status, rusage=None):
+
+        '''This sets the status attributes from a wait status and resource
+        usage for isalive(). '''
+
+        self.rusage = rusage
         if os.WIFEXITED(status):
             self.status = status
             self.exitstatus = os.WEXITSTATUS(status)
@@ -1263,7 +1940,44 @@ class spawn(object):
                     'where child process is stopped. This is not ' +
                     'supported. Is some other process attempting ' +
                     'job control with our child pid?')
-        return False
+        self._report_exit()
+
+    def resource_usage(self):
+
+        '''This returns a summary of the child once it has exited: a dict
+        with its 'pid', 'command', 'exitstatus', 'signalstatus' and the
+        'wall_time' in seconds from its start until its exit was noticed.
+        Where its resource usage is known (see the rusage attribute) there
+        are also 'user_time' and 'system_time' in seconds of CPU time,
+        'max_rss' (in kilobytes on Linux, bytes on macOS), and
+        'voluntary_switches' and 'involuntary_switches', the number of
+        context switches. This returns None while the child is running. '''
+
+        if not self.terminated or self.start_time is None:
+            return None
+        summary = {'pid': self.pid, 'command': self.command,
+                   'exitstatus': self.exitstatus,
+                   'signalstatus': self.signalstatus,
+                   'wall_time': self._exit_time - self.start_time}
+        if self.rusage is not None:
+            summary['user_time'] = self.rusage.ru_utime
+            summary['system_time'] = self.rusage.ru_stime
+            summary['max_rss'] = self.rusage.ru_maxrss
+            summary['voluntary_switches'] = self.rusage.ru_nvcsw
+            summary['involuntary_switches'] = self.rusage.ru_nivcsw
+        return summary
+
+    def _report_exit(self):
+
+        '''This passes the resource_usage() of the child to each function
+        in exit_hooks, once it has exited. '''
+
+        self._exit_time = time.time()
+        self._orphan['terminated'] = True
+        if exit_hooks:
+            summary = self.resource_usage()
+            for hook in list(exit_hooks):
+                hook(self, summary)
 
     def kill(self, sig):
 
@@ -1273,7 +1987,12 @@ class spawn(object):
 
         # Same as os.kill, but the pid is given for you.
         if self.isalive():
-            os.kill(self.pid, sig)
+            if self._reaper is not None:
+                # The reaper may have reaped the child since isalive(), and
+                # then the pid could belong to another process by now.
+                self._reaper.kill(self.pid, sig)
+            else:
+                os.kill(self.pid, sig)
 
     def _pattern_type_err(self, pattern):
         raise TypeError('got {badtype} ({badobj!r}) as pattern, must be one'
@@ -1308,6 +2027,9 @@ class spawn(object):
                 ...
                 i = self.expect_list(clp, timeout)
                 ...
+
+        Compiled patterns are kept in pattern_cache, so this is only
+        expensive the first time a pattern is seen by any spawn instance.
         '''
 
         if patterns is None:
@@ -1323,7 +2045,11 @@ class spawn(object):
         for idx, p in enumerate(patterns):
             if isinstance(p, self.allowed_string_types):
                 p = self._coerce_expect_string(p)
-                compiled_pattern_list.append(re.compile(p, compile_flags))
+                # The type is part of the key because 'a' == u'a' on
+                # Python 2.
+                compiled_pattern_list.append(pattern_cache.get(
+                        ('re.compile', type(p), p, compile_flags),
+                        lambda: re.compile(p, compile_flags)))
             elif p is EOF:
                 compiled_pattern_list.append(EOF)
             elif p is TIMEOUT:
@@ -1425,10 +2151,19 @@ class spawn(object):
         may help if you are trying to optimize for speed, otherwise just use
         the expect() method.  This is called by expect(). If timeout==-1 then
         the self.timeout value is used. If searchwindowsize==-1 then the
-        self.searchwindowsize value is used. '''
+        self.searchwindowsize value is used.
 
-        return self.expect_loop(searcher_re(pattern_list),
-                timeout, searchwindowsize)
+        If self.combine_patterns is True, the patterns are merged into a
+        single regular expression so the input is scanned once for all of
+        them. The result is the same, including 'match', which is the match
+        object of the pattern that matched. Patterns that cannot be merged
+        are searched for one at a time as usual. '''
+
+        combine = self.combine_patterns
+        searcher = pattern_cache.get(
+                ('searcher_re', tuple(pattern_list), combine),
+                lambda: searcher_re(pattern_list, combine=combine))
+        return self.expect_loop(searcher.copy(), timeout, searchwindowsize)
 
     def expect_exact(self, pattern_list, timeout=-1, searchwindowsize=-1):
 
@@ -1460,8 +2195,10 @@ class spawn(object):
         except TypeError:
             self._pattern_type_err(pattern_list)
         pattern_list = [prepare_pattern(p) for p in pattern_list]
-        return self.expect_loop(searcher_string(pattern_list),
-                timeout, searchwindowsize)
+        key = tuple((type(p), p) for p in pattern_list)
+        searcher = pattern_cache.get(('searcher_string',) + key,
+                lambda: searcher_string(pattern_list))
+        return self.expect_loop(searcher.copy(), timeout, searchwindowsize)
 
     def expect_loop(self, searcher, timeout=-1, searchwindowsize=-1):
 
@@ -1480,33 +2217,81 @@ class spawn(object):
         if searchwindowsize == -1:
             searchwindowsize = self.searchwindowsize
 
+        # Incoming data is collected in a growable buffer, so that reading a
+        # lot of output before a match costs linear rather than quadratic
+        # time. It is turned back into string_type for the caller.
+        string_type = self.string_type
+        spill = self.spill_threshold is not None
+        if spill and not issubclass(string_type, bytes):
+            raise ExceptionPexpect('spill_threshold only works with bytes, '
+                                   'not with spawnu.')
+        # A spill_buffer can only grow, see spill_buffer.
+        maxbuffer = None if spill else self.maxbuffer
+        maxread_range = self.maxread_range
+        if maxread_range is not None:
+            self.maxread = min(max(self.maxread, maxread_range[0]),
+                               maxread_range[1])
+        arena = self._read_arena()
+        drain_limit = self.drain_limit
+        if type(self).read_nonblocking != spawn.read_nonblocking:
+            # Draining reads around it would bypass the override.
+            drain_limit = None
         try:
-            incoming = self.buffer
+            if not spill:
+                incoming = self.receive_buffer_type(self.buffer)
+            elif (isinstance(self.buffer, spilled_output) and
+                    self.buffer._whole_store() is not None):
+                # Go on appending to it rather than copying it.
+                incoming = self.buffer._whole_store()
+            else:
+                incoming = spill_buffer(self.buffer, self.spill_threshold,
+                                        self.spill_dir)
             freshlen = len(incoming)
             while True:
                 # Keep reading until exception or return.
-                index = searcher.search(incoming, freshlen, searchwindowsize)
+                index = searcher.search(incoming.data if spill else incoming,
+                                        freshlen, searchwindowsize)
                 if index >= 0:
-                    self.buffer = incoming[searcher.end:]
-                    self.before = incoming[: searcher.start]
-                    self.after = incoming[searcher.start: searcher.end]
+                    # incoming must not be changed from here on: the match
+                    # object refers to it.
+                    self.buffer = self._received(incoming, searcher.end)
+                    self.before = self._received(incoming,
+                            self._before_start(searcher.start), searcher.start)
+                    self.after = string_type(
+                            incoming[searcher.start: searcher.end])
                     self.match = searcher.match
                     self.match_index = index
                     return self.match_index
                 # No match at this point
                 if (timeout is not None) and (timeout < 0):
                     raise TIMEOUT('Timeout exceeded in expect_any().')
+                # Everything has been searched, so this is the time to drop
+                # what will not fit.
+                if maxbuffer is not None and len(incoming) > maxbuffer:
+                    incoming = self._discard(
+                            incoming, len(incoming) - maxbuffer, searcher)
                 # Still have time left, so read more data
-                c = self.read_nonblocking(self.maxread, timeout)
-                freshlen = len(c)
-                time.sleep(0.0001)
-                incoming = incoming + c
+                if arena is not None:
+                    freshlen = self.read_nonblocking_into(
+                            arena[:self.maxread], timeout)
+                    incoming += arena[:freshlen]
+                else:
+                    c = self.read_nonblocking(self.maxread, timeout)
+                    freshlen = len(c)
+                    incoming += c
+                if maxread_range is not None:
+                    self._tune_maxread(freshlen)
+                if drain_limit is not None:
+                    incoming, drained = self._drain(incoming, arena,
+                                                    drain_limit - freshlen)
+                    freshlen += drained
                 if timeout is not None:
                     timeout = end_time - time.time()
         except EOF:
             err = sys.exc_info()[1]
             self.buffer = self.string_type()
-            self.before = incoming
+            self.before = self._received(incoming,
+                                         self._before_start(len(incoming)))
             self.after = EOF
             index = searcher.eof_index
             if index >= 0:
@@ -1519,8 +2304,13 @@ class spawn(object):
                 raise EOF(str(err) + '\n' + str(self))
         except TIMEOUT:
             err = sys.exc_info()[1]
-            self.buffer = incoming
-            self.before = incoming
+            self.buffer = self._received(incoming)
+            # Nothing is lost here, the rest is still in the buffer.
+            if (self.maxbefore is not None and
+                    len(self.buffer) > self.maxbefore):
+                self.before = self.buffer[len(self.buffer) - self.maxbefore:]
+            else:
+                self.before = self.buffer
             self.after = TIMEOUT
             index = searcher.timeout_index
             if index >= 0:
@@ -1532,12 +2322,125 @@ class spawn(object):
                 self.match_index = None
                 raise TIMEOUT(str(err) + '\n' + str(self))
         except:
-            self.before = incoming
+            self.before = self._received(incoming)
             self.after = None
             self.match = None
             self.match_index = None
             raise
 
+    def _drain(self, incoming, arena, limit):
+
+        '''This is used by expect_loop() in drain_limit mode. It appends
+        whatever else the child has already written to 'incoming', up to
+        about 'limit' bytes, without waiting for more. This returns
+        'incoming' and how much was added to it. EOF is left for the next
+        read_nonblocking() to report.
+
+        child_fd is polled before each read rather than set to O_NONBLOCK,
+        which would also affect whoever else shares the open file, as with
+        fdspawn on a serial line or an inherited stdin. '''
+
+        drained = 0
+        while drained < limit:
+            if not self.__select([self.child_fd], 0):
+                break
+            try:
+                if arena is not None:
+                    n = self._readinto(arena[:self.maxread])
+                    data = arena[:n]
+                else:
+                    data = os.read(self.child_fd, self.maxread)
+                    n = len(data)
+            except OSError:
+                # EIO at the end.
+                break
+            if n == 0:
+                break
+            if arena is not None:
+                if (self.logfile is not None or
+                        self.logfile_read is not None):
+                    self._log(bytes(data), 'read')
+            else:
+                self.read_allocations += 1
+                data = self._coerce_read_string(data)
+                self._log(data, 'read')
+            incoming += data
+            drained += n
+            if self.maxread_range is not None:
+                self._tune_maxread(n)
+        return incoming, drained
+
+    def _read_arena(self):
+
+        '''This returns a memoryview of the arena expect_loop() reads into,
+        allocating it the first time or when maxread has grown past it. With
+        maxread_range set, it is made big enough for the largest maxread
+        straight away. This returns None if reads have to go through
+        read_nonblocking(), because a subclass overrides it, the data has to
+        be decoded, or there is no memoryview (Python 2.6). '''
+
+        if not _have_memoryview:
+            return None
+        cls = type(self)
+        if (cls.read_nonblocking != spawn.read_nonblocking or
+                cls._coerce_read_string != spawn._coerce_read_string):
+            return None
+        size = self.maxread
+        if self.maxread_range is not None:
+            size = max(size, self.maxread_range[1])
+        if self._arena is None or len(self._arena) < size:
+            self._arena = memoryview(bytearray(size))
+            self.read_allocations += 1
+        return self._arena
+
+    def _tune_maxread(self, size):
+
+        '''This adjusts maxread within maxread_range after a read of 'size'
+        bytes. '''
+
+        smallest, largest = self.maxread_range
+        if size >= self.maxread:
+            # There is probably more where that came from.
+            self.maxread = min(largest, self.maxread * 2)
+        elif size < self.maxread // 8:
+            self.maxread = max(smallest, self.maxread // 2)
+
+    def _discard(self, incoming, size, searcher):
+
+        '''This drops the first 'size' bytes or characters of the unmatched
+        data in 'incoming' for maxbuffer, and tells the searcher, if it
+        keeps track of how far it has searched. '''
+
+        if isinstance(incoming, bytearray):
+            # This just moves the start of the bytearray along.
+            del incoming[:size]
+        else:
+            incoming = incoming[size:]
+        self.discarded += size
+        discard = getattr(searcher, 'discard', None)
+        if discard is not None:
+            discard(size)
+        return incoming
+
+    def _before_start(self, end):
+
+        '''This returns where 'before' starts when it ends at 'end' and the
+        data before that is thrown away, which depends on maxbefore. '''
+
+        if self.maxbefore is None or end <= self.maxbefore:
+            return 0
+        self.discarded += end - self.maxbefore
+        return end - self.maxbefore
+
+    def _received(self, incoming, start=0, end=None):
+
+        '''This returns incoming[start:end] from expect_loop() as string_type,
+        or as a spilled_output if it is too big to keep in memory. '''
+
+        if isinstance(incoming, spill_buffer):
+            return incoming.view(start, end)
+        return self.string_type(incoming[start:end])
+
     def getwinsize(self):
 
         '''This returns the terminal window size of the child tty. The return
@@ -1556,14 +2459,7 @@ class spawn(object):
         applications like vi or curses -- applications that respond to the
         SIGWINCH signal. '''
 
-        # Some very old platforms have a bug that causes the value for
-        # termios.TIOCSWINSZ to be truncated. There was a hack here to work
-        # around this, but it caused problems with newer platforms so has been
-        # removed. For details see https://github.com/pexpect/pexpect/issues/39
-        TIOCSWINSZ = getattr(termios, 'TIOCSWINSZ', -2146929561)
-        # Note, assume ws_xpixel and ws_ypixel are zero.
-        s = struct.pack('HHHH', rows, cols, 0, 0)
-        fcntl.ioctl(self.fileno(), TIOCSWINSZ, s)
+        _setwinsize(self.fileno(), rows, cols)
 
     def interact(self, escape_character=chr(29),
             input_filter=None, output_filter=None):
@@ -1604,7 +2500,11 @@ class spawn(object):
         '''
 
         # Flush the buffer.
-        self.write_to_stdout(self.buffer)
+        if isinstance(self.buffer, spilled_output):
+            for chunk in self.buffer.chunks():
+                self.write_to_stdout(chunk)
+        else:
+            self.write_to_stdout(self.buffer)
         self.stdout.flush()
         self.buffer = self.string_type()
         mode = tty.tcgetattr(self.STDIN_FILENO)
@@ -1637,7 +2537,7 @@ class spawn(object):
         '''
 
         while self.isalive():
-            r, w, e = self.__select([self.child_fd, self.STDIN_FILENO], [], [])
+            r = self.__select([self.child_fd, self.STDIN_FILENO])
             if self.child_fd in r:
                 try:
                     data = self.__interact_read(self.child_fd)
@@ -1662,21 +2562,24 @@ class spawn(object):
                     break
                 self.__interact_writen(self.child_fd, data)
 
-    def __select(self, iwtd, owtd, ewtd, timeout=None):
+    def __select(self, fds, timeout=None):
 
-        '''This is a wrapper around select.select() that ignores signals. If
-        select.select raises a select.error exception and errno is an EINTR
-        error then it is ignored. Mainly this is used to ignore sigwinch
-        (terminal resize). '''
+        '''This waits for the file descriptors in 'fds' to become readable,
+        and returns the list of those that are, using a poller_type instance.
+        It ignores signals: if the wait is interrupted with EINTR it is
+        started again. Mainly this is used to ignore sigwinch (terminal
+        resize). '''
 
-        # if select() is interrupted by a signal (errno==EINTR) then
-        # we loop back and enter the select() again.
+        if self._poller is None:
+            self._poller = self.poller_type()
+        # if the wait is interrupted by a signal (errno==EINTR) then
+        # we loop back and wait again.
         if timeout is not None:
             end_time = time.time() + timeout
         while True:
             try:
-                return select.select(iwtd, owtd, ewtd, timeout)
-            except select.error:
+                return self._poller.wait(fds, timeout)
+            except (select.error, IOError, OSError):
                 err = sys.exc_info()[1]
                 if err.args[0] == errno.EINTR:
                     # if we loop back we have to subtract the
@@ -1684,7 +2587,7 @@ class spawn(object):
                     if timeout is not None:
                         timeout = end_time - time.time()
                         if timeout < 0:
-                            return([], [], [])
+                            return []
                 else:
                     # something else caused the select.error, so
                     # this actually is an exception.
@@ -1735,6 +2638,11 @@ class spawnu(spawn):
         allowed_string_types = (unicode, )
         _chr = staticmethod(unichr)
         linesep = os.linesep.decode('ascii')
+    # There is no mutable unicode string, but CPython resizes a string in
+    # place when += is used on the only reference to it.
+    receive_buffer_type = string_type
+    crlf = string_type('\r\n')
+    _crlf_re = re.compile(crlf)
     # This can handle unicode in both Python 2 and 3
     write_to_stdout = sys.stdout.write
 
@@ -1759,42 +2667,1031 @@ class spawnu(spawn):
         return os.write(self.child_fd, s.encode(self.encoding, self.errors))
 
 
-class searcher_string(object):
+def close_all(sessions, force=True, deadline=None):
+
+    '''This closes many spawn instances at once, which is much quicker than
+    calling close() on each in turn. It closes all of their ptys and then
+    goes through the signals of terminate(), sending each one to all the
+    children that are still running together, and waiting for them together
+    for up to the longest delayafterclose or delayafterterminate of those
+    sessions. Each wait ends once all of them have exited.
+
+    If 'deadline' is given, once that many seconds have passed the children
+    still running are sent SIGKILL, if 'force' is True, without going
+    through the gentler signals first. This returns a list with the
+    (exitstatus, signalstatus) of each session, in order, or None where the
+    child could not be terminated. '''
+
+    sessions = list(sessions)
+    if deadline is not None:
+        end_time = time.time() + deadline
+    children = []
+    for session in sessions:
+        if session.closed:
+            continue
+        if (session.pid is None or
+                getattr(type(session), 'close', None) is not spawn.close):
+            # Such as fdspawn, which has no child of its own, or a class
+            # that does more in its own close().
+            session.close()
+            continue
+        session._close_pty()
+        children.append(session)
+
+    steps = [(None, 'delayafterclose'), (signal.SIGHUP, 'delayafterterminate'),
+             (signal.SIGCONT, 'delayafterterminate'),
+             (signal.SIGINT, 'delayafterterminate')]
+    if force:
+        steps.append((signal.SIGKILL, 'delayafterterminate'))
+    for sig, delay in steps:
+        children = [child for child in children if child.isalive()]
+        if not children:
+            break
+        gentle = sig != signal.SIGKILL
+        if gentle and deadline is not None and time.time() >= end_time:
+            continue
+        if sig is not None:
+            for child in children:
+                try:
+                    child.kill(sig)
+                except OSError:
+                    pass
+        timeout = max(getattr(child, delay) for child in children)
+        if gentle and deadline is not None:
+            timeout = min(timeout, end_time - time.time())
+        _wait_exits(children, timeout)
+
+    results = []
+    for session in sessions:
+        if session.pid is not None and session.isalive():
+            results.append(None)
+        else:
+            results.append((session.exitstatus, session.signalstatus))
+        session._close_pidfd()
+    return results
 
-    '''This is a plain string search helper for the spawn.expect_any() method.
-    This helper class is for speed. For more powerful regex patterns
-    see the helper class, searcher_re.
 
-    Attributes:
+def _wait_exits(children, timeout):
 
-        eof_index     - index of EOF, or -1
-        timeout_index - index of TIMEOUT, or -1
+    '''This waits up to 'timeout' seconds for all of the spawn instances in
+    'children' to exit, as spawn._wait_exit() does for one. It waits on the
+    pidfds of those that have one all together, and returns True if they
+    have all exited. '''
 
-    After a successful match by the search() method the following attributes
-    are available:
+    end_time = time.time() + timeout
+    delay = 0.001
+    poll = select.poll()
+    registered = {}
+    for child in children:
+        if child._pidfd is not None and not child._pidfd_ready:
+            poll.register(child._pidfd, select.POLLIN)
+            registered[child._pidfd] = child
 
-        start - index into the buffer, first byte of match
-        end   - index into the buffer, first byte after match
-        match - the matching string itself
+    while True:
+        pending = []
+        for child in children:
+            if child._pidfd is not None and not child._pidfd_ready:
+                # Still running, as far as its pidfd says.
+                pending.append(child)
+            elif child.isalive():
+                pending.append(child)
+        for fd, child in list(registered.items()):
+            if child._pidfd_ready:
+                poll.unregister(fd)
+                del registered[fd]
+        children = pending
+        if not children:
+            return True
+        timeout = end_time - time.time()
+        if timeout <= 0:
+            return False
+        if len(registered) < len(children):
+            # Some have to be asked with isalive() from time to time.
+            timeout = min(delay, timeout)
+            delay = delay * 2
+        if registered:
+            # poll() takes milliseconds; round up so as not to spin.
+            for fd, event in poll.poll(int(math.ceil(timeout * 1000))):
+                registered[fd]._pidfd_ready = True
+        else:
+            time.sleep(timeout)
 
-    '''
 
-    def __init__(self, strings):
+class spawn_server(object):
 
-        '''This creates an instance of searcher_string. This argument 'strings'
-        may be a list; a sequence of strings; or the EOF or TIMEOUT types. '''
+    '''This is a process that starts children for spawn objects. Forking
+    a large process is slow, so create one of these early, while this process
+    is still small, and pass it to spawn() as ``spawn_server``::
 
-        self.eof_index = -1
-        self.timeout_index = -1
-        self._strings = []
-        for n, s in enumerate(strings):
-            if s is EOF:
-                self.eof_index = n
-                continue
-            if s is TIMEOUT:
-                self.timeout_index = n
-                continue
-            self._strings.append((n, s))
+        server = pexpect.spawn_server()
+        ...
+        child = pexpect.spawn('ssh user@example.com', spawn_server=server)
+
+    The server is forked from this process (and is not a child of it), and
+    talks to it over a Unix socket. For each spawn it forks and execs the
+    child on a new pty, and passes the pty back with SCM_RIGHTS, together
+    with a socket it sends the wait status of the child to when it exits.
+    Since the environment and working directory are sent with each request,
+    children see those of this process as it is at the time, as they would
+    with fork(). The server needs socket.sendmsg() (Python 3.3 or later) and
+    AF_UNIX SOCK_SEQPACKET sockets (Linux and most BSDs). '''
+
+    def __init__(self):
+
+        if not hasattr(socket.socket, 'sendmsg'):
+            raise ExceptionPexpect('spawn_server needs socket.sendmsg().')
+        sock, server_sock = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            # Fork again, so that the server does not have to be waited for.
+            try:
+                sock.close()
+                if os.fork() == 0:
+                    _spawn_server_main(server_sock)
+            except:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        server_sock.close()
+        os.waitpid(pid, 0)
+        self._sock = sock
+        self._lock = threading.Lock()
+
+    def _start(self, child):
+
+        '''This asks the server to start the command of the spawn object
+        'child', and returns its pid, the pty and the exit status socket. '''
+
+        env = child.env
+        if env is None:
+            env = dict(os.environ)
+        cwd = child.cwd
+        if cwd is None:
+            cwd = os.getcwd()
+        request = pickle.dumps((child.command, child.args, env, cwd,
+                                child.ignore_sighup, child.pass_fds))
+        if len(request) > _spawn_request_size:
+            raise ExceptionPexpect('The request to the spawn server is too '
+                                   'large (%d bytes); is the environment '
+                                   'that big?' % len(request))
+        if len(child.pass_fds) > _spawn_request_fds:
+            raise ExceptionPexpect('Too many pass_fds for the spawn server.')
+        with self._lock:
+            if self._sock is None:
+                raise ExceptionPexpect('The spawn server is closed.')
+            _send_fds(self._sock, request, child.pass_fds)
+            reply, fds = _recv_fds(self._sock, 4096, 2)
+        if not reply:
+            raise ExceptionPexpect('The spawn server has exited.')
+        pid, error = pickle.loads(reply)
+        if error is not None:
+            for fd in fds:
+                os.close(fd)
+            raise ExceptionPexpect('The spawn server could not start the '
+                                   'child: ' + error)
+        return pid, fds[0], fds[1]
+
+    def close(self):
+
+        '''This tells the server to exit. It stops starting children at
+        once, but goes on reporting the exit status of those it started
+        until they have all exited. '''
+
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+
+class child_reaper(object):
+
+    '''This collects the exit status of the children of spawn instances in
+    a background thread, as soon as they exit, so that isalive() only has
+    to look it up. Use start_reaper() and stop_reaper() rather than making
+    one of these. The thread waits on a pidfd for each child where there
+    are pidfds (Linux); elsewhere it is woken by SIGCHLD, if it was started
+    from the main thread, or else looks every 'interval' seconds.
+
+    The status is collected with os.wait4() where there is one, so the
+    resource usage of the child comes with it. If something else reaps a
+    child first, its status is recorded as None rather than treated as an
+    error. '''
+
+    interval = 0.05
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._exited = threading.Condition(self._lock)
+        # pid -> (pidfd or None, whether to close it), for children not yet
+        # reaped.
+        self._children = {}
+        # pid -> (status, rusage) for children reaped, until forgotten.
+        self._statuses = {}
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._thread = None
+        self._stopping = False
+        self._previous_handler = None
+        self._poll_timeout = None
+
+    @property
+    def running(self):
+
+        return self._thread is not None and not self._stopping
+
+    def start(self):
+
+        '''This starts the thread. '''
+
+        if not hasattr(os, 'pidfd_open'):
+            try:
+                self._previous_handler = signal.signal(signal.SIGCHLD,
+                                                       self._sigchld)
+            except ValueError:
+                # Not the main thread, so look from time to time instead.
+                self._poll_timeout = int(self.interval * 1000)
+        self._thread = threading.Thread(target=self._run,
+                                        name='pexpect child reaper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+
+        '''This stops the thread. Statuses already collected can still be
+        looked up; children not yet reaped are left to isalive(). '''
+
+        with self._lock:
+            if not self.running:
+                return
+            self._stopping = True
+            self._exited.notify_all()
+        self._wake()
+        self._thread.join()
+        if self._previous_handler is not None:
+            try:
+                signal.signal(signal.SIGCHLD, self._previous_handler)
+            except ValueError:
+                pass
+        with self._lock:
+            for pid, (fd, owned) in self._children.items():
+                if owned:
+                    os.close(fd)
+            self._children.clear()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def register(self, pid, pidfd=None):
+
+        '''This starts watching the child 'pid'. If the caller already has a
+        'pidfd' for it, the reaper watches that one rather than opening its
+        own, and the caller hands it back with release() instead of closing
+        it. '''
+
+        owned = False
+        if pidfd is None and hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(pid)
+                owned = True
+            except OSError:
+                pass
+        with self._lock:
+            self._children[pid] = (pidfd, owned)
+        self._wake()
+
+    def release(self, pid, pidfd):
+
+        '''This closes the 'pidfd' given to register(), or, if the child has
+        not been reaped yet, leaves the reaper to close it once it is. '''
+
+        with self._lock:
+            if self._children.get(pid, (None,))[0] == pidfd:
+                self._children[pid] = (pidfd, True)
+                return
+        try:
+            os.close(pidfd)
+        except OSError:
+            pass
+
+    def kill(self, pid, sig):
+
+        '''This sends the signal 'sig' to the child 'pid', unless it has been
+        reaped already, as then the pid may have been reused by another
+        process. It returns whether the signal was sent. '''
+
+        # Children are only reaped with the lock held, so the pid cannot be
+        # freed between the lookup and os.kill().
+        with self._lock:
+            if pid in self._statuses:
+                return False
+            os.kill(pid, sig)
+            return True
+
+    def status(self, pid):
+
+        '''This returns the (status, rusage) of the child 'pid' if it has
+        been reaped, or else None. '''
+
+        with self._lock:
+            return self._statuses.get(pid)
+
+    def wait(self, pid, timeout=None):
+
+        '''This waits until the child 'pid' has been reaped and returns its
+        (status, rusage), or None after 'timeout' seconds or if the reaper is
+        stopped. '''
+
+        if timeout is not None:
+            end_time = time.time() + timeout
+        with self._exited:
+            while pid not in self._statuses and self.running:
+                if timeout is None:
+                    self._exited.wait()
+                else:
+                    timeout = end_time - time.time()
+                    if timeout <= 0:
+                        break
+                    self._exited.wait(timeout)
+            return self._statuses.get(pid)
+
+    def forget(self, pid):
+
+        '''This drops the status of the child 'pid' once it has been read. '''
+
+        with self._lock:
+            self._statuses.pop(pid, None)
+
+    def _sigchld(self, signum, frame):
+
+        self._wake()
+        if callable(self._previous_handler):
+            self._previous_handler(signum, frame)
+
+    def _wake(self):
+
+        try:
+            os.write(self._wakeup_write, b'x')
+        except OSError:
+            # The pipe is full, so the thread will wake anyway.
+            pass
+
+    def _run(self):
+
+        poll = select.poll()
+        poll.register(self._wakeup_read, select.POLLIN)
+        polled = {}
+        while True:
+            try:
+                events = poll.poll(self._poll_timeout)
+            except (select.error, IOError, OSError):
+                err = sys.exc_info()[1]
+                if err.args[0] != errno.EINTR:
+                    raise
+                events = []
+            try:
+                while os.read(self._wakeup_read, 512):
+                    pass
+            except OSError:
+                pass
+            with self._lock:
+                if self._stopping:
+                    return
+                for pid, (fd, owned) in self._children.items():
+                    if fd is not None and fd not in polled:
+                        poll.register(fd, select.POLLIN)
+                        polled[fd] = pid
+                ready = set(polled[fd] for fd, event in events
+                            if fd in polled)
+                pids = [pid for pid, (fd, owned) in self._children.items()
+                        if fd is None or pid in ready]
+                # Reaping with the lock held keeps kill() from signalling a
+                # pid that has just been freed.
+                for pid in pids:
+                    result = _reap(pid)
+                    if result is None:
+                        continue
+                    fd, owned = self._children.pop(pid)
+                    if fd is not None:
+                        poll.unregister(fd)
+                        del polled[fd]
+                        if owned:
+                            os.close(fd)
+                    self._statuses[pid] = result
+                    self._exited.notify_all()
+
+
+def _wait4(pid, options):
+
+    '''This is os.wait4() where there is one, or else os.waitpid() with
+    None for the resource usage. '''
+
+    if hasattr(os, 'wait4'):
+        return os.wait4(pid, options)
+    pid, status = os.waitpid(pid, options)
+    return pid, status, None
+
+
+def _reap(pid):
+
+    '''This reaps the child 'pid' if it has exited, and returns its
+    (status, rusage), or (None, None) if it was already reaped by something
+    else. It returns None if the child is still running. '''
+
+    try:
+        pid, status, rusage = _wait4(pid, os.WNOHANG)
+    except OSError:
+        err = sys.exc_info()[1]
+        if err.errno != errno.ECHILD:
+            raise
+        return None, None
+    if pid == 0:
+        return None
+    return status, rusage
+
+
+# The child_reaper of start_reaper(), if it is running.
+_reaper = None
+
+# Functions called as hook(child, summary) when the exit status of the child
+# of a spawn instance is collected, with its resource_usage() as 'summary'.
+exit_hooks = []
+
+
+def start_reaper():
+
+    '''This starts a child_reaper for the children of spawn instances made
+    from now on, and returns it. Once a child exits its status is collected
+    at once, so no zombie is left until isalive() or close() is called, and
+    isalive() does not need to call waitpid(). Calling this again returns
+    the same reaper. '''
+
+    global _reaper
+    if _reaper is None:
+        reaper = child_reaper()
+        reaper.start()
+        _reaper = reaper
+    return _reaper
+
+
+def stop_reaper():
+
+    '''This stops the reaper of start_reaper(). Children it has not
+    reaped yet are waited for by isalive() as usual. '''
+
+    global _reaper
+    reaper, _reaper = _reaper, None
+    if reaper is not None:
+        reaper.stop()
+
+
+def _abandon_child(orphan):
+
+    '''This is the weakref.finalize of a spawn instance garbage collected
+    without being closed. 'orphan' is its _orphan dict. It closes the pty at
+    once and leaves the child, if it has not exited yet, to _orphans, which
+    gives it delayafterclose to exit and then sends it the signals of
+    terminate() in a background thread. So dropping a spawn instance never
+    waits for its child. '''
+
+    _finalizers.pop(id(orphan), None)
+    if orphan['child_fd'] is not None:
+        try:
+            os.close(orphan['child_fd'])
+        except OSError:
+            pass
+    pidfd = orphan['pidfd']
+    if orphan['terminated']:
+        if pidfd is not None:
+            _close_child_pidfd(orphan['pid'], pidfd, orphan['reaper'])
+        return
+    _orphans.adopt(orphan['pid'], pidfd, orphan['own_child'],
+                   orphan['reaper'], orphan['delayafterclose'],
+                   orphan['delayafterterminate'])
+
+
+def _close_child_pidfd(pid, fd, reaper):
+
+    '''This closes the pidfd of an abandoned child, which it shares with
+    'reaper' if that is not None. '''
+
+    if reaper is not None:
+        reaper.release(pid, fd)
+        return
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+
+class _orphanage(object):
+
+    '''This terminates and reaps the children handed to it by
+    _abandon_child(). A child that has not exited after 'delayafterclose'
+    is sent SIGHUP, SIGCONT, SIGINT and SIGKILL in turn, 'delayafterterminate'
+    apart, as by terminate(force=True). The thread only runs while there are
+    children left, and is not a daemon thread, so the interpreter waits for
+    it before it exits. Children abandoned later than that, by the time the
+    atexit functions run, are terminated by finish() instead.
+
+    Each child comes with its pidfd, or for a child of a spawn_server the
+    socket its exit status arrives on. The thread waits on those, but also
+    looks every 'interval' seconds, for children adopted meanwhile and for
+    children without a pidfd.
+
+    adopt() is called by the garbage collector, which can run in the middle
+    of anything, including adopt() itself or the start of the thread. So it
+    only ever appends to a deque and never waits for the lock: whoever holds
+    the lock looks at the deque again before letting go of the thread. '''
+
+    interval = 0.05
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        # (pid, fd, own_child, reaper, delayafterclose, delayafterterminate)
+        # of the children adopted since the thread last looked.
+        self._adopted = collections.deque()
+        # pid -> [fd, own_child, reaper, deadline, signals left, delay], of
+        # the children the thread is looking after. Only it uses this.
+        self._children = {}
+        self._thread = None
+        # Set by finish(), after which no thread is started.
+        self._exiting = False
+
+    def __len__(self):
+
+        return len(self._adopted) + len(self._children)
+
+    def adopt(self, pid, fd, own_child, reaper, delayafterclose,
+              delayafterterminate):
+
+        self._adopted.append((pid, fd, own_child, reaper, delayafterclose,
+                              delayafterterminate))
+        self._start()
+
+    def finish(self):
+
+        '''This terminates the children left, without a thread, and returns
+        once they have all exited. It is called at exit. '''
+
+        with self._lock:
+            self._exiting = True
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self._reap_children()
+
+    def _start(self):
+
+        if self._exiting:
+            return
+        if not self._lock.acquire(False):
+            # Either a thread is being started, which will find the child,
+            # or the thread is about to stop, and will call this again.
+            return
+        try:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='pexpect orphan reaper')
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _take_adopted(self):
+
+        signals = (signal.SIGHUP, signal.SIGCONT, signal.SIGINT,
+                   signal.SIGKILL)
+        while self._adopted:
+            (pid, fd, own_child, reaper, delayafterclose,
+             delayafterterminate) = self._adopted.popleft()
+            self._children[pid] = [fd, own_child, reaper,
+                                   time.time() + delayafterclose,
+                                   list(signals), delayafterterminate]
+
+    def _exited(self, pid, fd, own_child, reaper):
+
+        if reaper is not None and reaper.running:
+            if reaper.status(pid) is None:
+                return False
+            reaper.forget(pid)
+            return True
+        if own_child:
+            return _reap(pid) is not None
+        # A child of a spawn_server: the server reaps it, and its exit status
+        # makes the socket readable.
+        if hasattr(select, 'poll'):
+            poll = select.poll()
+            poll.register(fd, select.POLLIN)
+            return bool(poll.poll(0))
+        return bool(select.select([fd], [], [], 0)[0])
+
+    def _run(self):
+
+        while True:
+            self._reap_children()
+            stopping = False
+            with self._lock:
+                if not self._adopted:
+                    self._thread = None
+                    stopping = True
+            if not stopping:
+                continue
+            # Something adopted after the lock was let go of would otherwise
+            # wait for the next adopt().
+            if self._adopted:
+                self._start()
+            return
+
+    def _reap_children(self):
+
+        while True:
+            self._take_adopted()
+            if not self._children:
+                return
+            children = list(self._children.items())
+            now = time.time()
+            timeout = self.interval
+            fds = []
+            for pid, child in children:
+                fd, own_child, reaper, deadline, signals, delay = child
+                try:
+                    exited = self._exited(pid, fd, own_child, reaper)
+                except (OSError, select.error, ValueError):
+                    exited = True
+                if exited:
+                    if fd is not None:
+                        _close_child_pidfd(pid, fd, reaper)
+                    del self._children[pid]
+                    continue
+                if signals and now >= deadline:
+                    try:
+                        if reaper is not None:
+                            reaper.kill(pid, signals.pop(0))
+                        else:
+                            os.kill(pid, signals.pop(0))
+                    except OSError:
+                        pass
+                    deadline = child[3] = now + delay
+                if signals:
+                    timeout = min(timeout, max(deadline - now, 0))
+                if fd is not None:
+                    fds.append(fd)
+            if fds and hasattr(select, 'poll'):
+                poll = select.poll()
+                for fd in fds:
+                    poll.register(fd, select.POLLIN)
+                try:
+                    poll.poll(int(math.ceil(timeout * 1000)))
+                except (OSError, select.error):
+                    pass
+            else:
+                time.sleep(timeout)
+
+
+# Where _abandon_child() leaves the children of spawn instances.
+_orphans = _orphanage()
+
+# id(spawn._orphan) -> the weakref.finalize of each spawn instance with a
+# child, until it is closed or collected.
+_finalizers = {}
+
+
+def _finish_orphans():
+
+    '''This is called at exit. The weakref.finalize callbacks would only run
+    after the interpreter has waited for its non-daemon threads, too late
+    for _orphans to start one, so the children of spawn instances still
+    open are abandoned here and terminated before the interpreter exits. '''
+
+    _orphans._exiting = True
+    for finalizer in list(_finalizers.values()):
+        # Calling it would do nothing once weakref has begun to shut down.
+        info = finalizer.detach()
+        if info is not None:
+            obj, func, args, kwargs = info
+            func(*args)
+    _orphans.finish()
+
+atexit.register(_finish_orphans)
+
+
+class spill_buffer(object):
+
+    '''This is the receive buffer expect_loop() uses when spawn.spill_threshold
+    is set. Data is kept in a bytearray until there is more than 'threshold'
+    bytes of it; from then on it is kept in an unnamed temporary file in
+    'dir' which is mapped into memory. The kernel can write the pages of the
+    file out and drop them when memory is short, so a huge output does not
+    have to fit in the memory of the process.
+
+    Data can only be appended, with +=, so views of what is already there
+    stay valid. The 'data' attribute is the bytearray or the mmap; the
+    searchers look at it directly, without copying. '''
+
+    def __init__(self, data=b'', threshold=16 * 1024 * 1024, dir=None):
+
+        self.threshold = threshold
+        self.dir = dir
+        self.data = bytearray()
+        self._file = None
+        self += data
+
+    def __len__(self):
+
+        return len(self.data)
+
+    def __getitem__(self, index):
+
+        return self.data[index]
+
+    def __iadd__(self, data):
+
+        if isinstance(data, spilled_output):
+            for chunk in data.chunks():
+                self += chunk
+            return self
+        start = len(self.data)
+        end = start + len(data)
+        if self._file is not None:
+            self.data.resize(end)
+        elif end <= self.threshold:
+            self.data += data
+            return self
+        else:
+            self._file = tempfile.TemporaryFile(dir=self.dir)
+            self._file.truncate(end)
+            spilled = mmap.mmap(self._file.fileno(), end)
+            spilled[:start] = bytes(self.data)
+            self.data = spilled
+        self.data[start:end] = data
+        return self
+
+    def view(self, start=0, end=None):
+
+        '''This returns the data from 'start' to 'end'. That is a copy as
+        bytes if the data is still in memory or is no more than 'threshold'
+        bytes long, otherwise it is a spilled_output. '''
+
+        if end is None:
+            end = len(self.data)
+        if self._file is None or end - start <= self.threshold:
+            return bytes(self.data[start:end])
+        return spilled_output(self, start, end)
+
+
+class spilled_output(object):
+
+    '''This is a read-only view of part of a spill_buffer. When a spawn
+    instance has spill_threshold set, 'before' and 'buffer' are one of these
+    instead of bytes if they are too big.
+
+    Indexing and slicing work as for bytes, and a slice is read into memory
+    as bytes. Use chunks() or write_to() to go through all of it, or
+    tobytes() if it is small enough after all. '''
+
+    def __init__(self, store, start, end):
+
+        self._store = store
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+
+        return self._end - self._start
+
+    def __repr__(self):
+
+        return '<spilled_output of %d bytes>' % len(self)
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            start, end, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('spilled_output slices can not have a step')
+            end = max(start, end)
+            return bytes(self._store.data[self._start + start:
+                                          self._start + end])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('spilled_output index out of range')
+        return self._store.data[self._start + index]
+
+    def view(self, start=0, end=None):
+
+        '''This returns the data from 'start' to 'end' the same way
+        spill_buffer.view() does, without reading it into memory if it is
+        big. '''
+
+        if end is None:
+            end = len(self)
+        return self._store.view(self._start + start, self._start + end)
+
+    def find(self, sub, start=0):
+
+        '''This returns the lowest index at or after 'start' where 'sub' is
+        found, or -1. '''
+
+        index = self._store.data.find(sub, self._start + start, self._end)
+        if index < 0:
+            return -1
+        return index - self._start
+
+    def chunks(self, size=1024 * 1024):
+
+        '''This generates the data as bytes, 'size' bytes at a time. '''
+
+        for start in range(self._start, self._end, size):
+            yield bytes(self._store.data[start:min(start + size, self._end)])
+
+    def write_to(self, f, size=1024 * 1024):
+
+        '''This writes all of the data to the file object 'f'. '''
+
+        for chunk in self.chunks(size):
+            f.write(chunk)
+
+    def tobytes(self):
+
+        '''This reads all of the data into memory and returns it as bytes. '''
+
+        return self[:]
+
+    __bytes__ = tobytes
+
+    def _whole_store(self):
+        # This returns the spill_buffer if this is a view of all of it.
+        if self._start == 0 and self._end == len(self._store):
+            return self._store
+        return None
+
+
+class _string_automaton(object):
+
+    '''This is an Aho-Corasick automaton used by searcher_string to look for
+    many plain strings in a single pass over the input. It is compiled once
+    from the list of (index, string) pairs and then fed the buffer one chunk
+    at a time; the current state is kept between chunks so nothing that has
+    already been scanned is ever looked at again.
+
+    The goto function is expanded into a full transition table, so feeding a
+    character is one dict lookup. Transitions that fall back to the root state
+    are not stored. While in the root state, a precompiled character class of
+    all the first characters is used to skip ahead to the next place where a
+    match could start. '''
+
+    def __init__(self, strings):
+
+        goto = [{}]
+        matches = [[]]
+        for index, s in strings:
+            state = 0
+            # Iterating gives ints for bytes on Python 3 and single
+            # characters otherwise, the same as indexing the buffer does.
+            for c in s:
+                nxt = goto[state].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][c] = nxt
+                    goto.append({})
+                    matches.append([])
+                state = nxt
+            matches[state].append((index, len(s)))
+
+        # Breadth first, so the failure state of every state has already
+        # been completed when it is needed.
+        fail = [0] * len(goto)
+        delta = [dict(goto[0])]
+        delta.extend({} for _ in range(len(goto) - 1))
+        queue = list(goto[0].values())
+        for state in queue:
+            delta[state] = dict(delta[fail[state]])
+            delta[state].update(goto[state])
+            matches[state].extend(matches[fail[state]])
+            for c, nxt in goto[state].items():
+                fail[nxt] = delta[fail[state]].get(c, 0)
+                queue.append(nxt)
+
+        self._delta = delta
+        # The lowest index wins when several strings start at the same
+        # place, so check them in that order.
+        self._matches = [sorted(m) or None for m in matches]
+        self.maxlen = max(len(s) for index, s in strings)
+        empty = strings[0][1][:0]
+        if isinstance(empty, bytes):
+            brackets = (b'[', b']')
+        else:
+            brackets = ('[', ']')
+        firsts = sorted(set(re.escape(s[:1]) for index, s in strings))
+        self._skip = re.compile(brackets[0] + empty.join(firsts) + brackets[1])
+        self.reset()
+
+    def reset(self):
+
+        '''This forgets everything that was fed to the automaton. '''
+
+        self.state = 0
+        self.pos = 0
+
+    def scan(self, buffer, pos, windowstart):
+
+        '''This feeds buffer[pos:] to the automaton, starting from the state
+        left over by the previous call. This returns (start, index) of the
+        leftmost match that starts at or after 'windowstart', picking the
+        lowest index if several start at the same place, or None. '''
+
+        delta = self._delta
+        matches = self._matches
+        skip = self._skip.search
+        state = self.state
+        limit = len(buffer)
+        best = None
+        while pos < limit:
+            if not state:
+                m = skip(buffer, pos, limit)
+                if m is None:
+                    pos = limit
+                    break
+                pos = m.start()
+            state = delta[state].get(buffer[pos], 0)
+            pos += 1
+            if matches[state] is None:
+                continue
+            for index, length in matches[state]:
+                start = pos - length
+                if start < windowstart:
+                    continue
+                if best is None or (start, index) < best:
+                    best = (start, index)
+                    # Anything that starts before this match must end
+                    # within maxlen of it; no need to look further.
+                    limit = min(limit, start + self.maxlen)
+        self.state = state
+        self.pos = pos
+        return best
+
+
+class searcher_string(object):
+
+    '''This is a plain string search helper for the spawn.expect_any() method.
+    This helper class is for speed. For more powerful regex patterns
+    see the helper class, searcher_re.
+
+    Setting automaton_threshold has lists of that many strings or more
+    compiled into an Aho-Corasick automaton, so each chunk of input is
+    scanned once for all of them rather than once per string. find() runs
+    in C and the automaton mostly in Python, so this only pays where the
+    first characters of the strings are rare in the input, or for a list of
+    a thousand strings or so; with common first characters it is several
+    times slower. tests/test_performance.py compares the two.
+
+    Attributes:
+
+        eof_index     - index of EOF, or -1
+        timeout_index - index of TIMEOUT, or -1
+
+    After a successful match by the search() method the following attributes
+    are available:
+
+        start - index into the buffer, first byte of match
+        end   - index into the buffer, first byte after match
+        match - the matching string itself
+
+    '''
+
+    # Scan with a _string_automaton when there are this many strings or more,
+    # or never if this is None.
+    automaton_threshold = None
+
+    def __init__(self, strings):
+
+        '''This creates an instance of searcher_string. This argument 'strings'
+        may be a list; a sequence of strings; or the EOF or TIMEOUT types. '''
+
+        self.eof_index = -1
+        self.timeout_index = -1
+        self._strings = []
+        for n, s in enumerate(strings):
+            if s is EOF:
+                self.eof_index = n
+                continue
+            if s is TIMEOUT:
+                self.timeout_index = n
+                continue
+            self._strings.append((n, s))
+        # With several strings to look for, scan the input once with an
+        # automaton instead of calling find() once for every string.
+        if (self.automaton_threshold is not None and
+                len(self._strings) >= self.automaton_threshold and
+                all(s for n, s in self._strings)):
+            self._automaton = _string_automaton(self._strings)
+            self._lookup = dict(self._strings)
+        else:
+            self._automaton = None
 
     def __str__(self):
 
@@ -1812,6 +3709,28 @@ class searcher_string(object):
         ss = list(zip(*ss))[1]
         return '\n'.join(ss)
 
+    def copy(self):
+
+        '''This returns a searcher for the same strings which shares the
+        compiled automaton with this one, but not the progress of a search.
+        This is how pattern_cache hands out searchers. '''
+
+        new = copy.copy(self)
+        if self._automaton is not None:
+            new._automaton = copy.copy(self._automaton)
+            new._automaton.reset()
+        return new
+
+    def discard(self, size):
+
+        '''This is called when the first 'size' bytes of the buffer have been
+        thrown away since the last search, see spawn.maxbuffer. '''
+
+        if self._automaton is not None:
+            self._automaton.pos -= size
+            if self._automaton.pos < 0:
+                self._automaton.reset()
+
     def search(self, buffer, freshlen, searchwindowsize=None):
 
         '''This searches 'buffer' for the first occurence of one of the search
@@ -1824,19 +3743,21 @@ class searcher_string(object):
         If there is a match this returns the index of that string, and sets
         'start', 'end' and 'match'. Otherwise, this returns -1. '''
 
+        if self._automaton is not None:
+            return self._search_automaton(buffer, freshlen, searchwindowsize)
+
         first_match = None
 
         # 'freshlen' helps a lot here. Further optimizations could
         # possibly include:
         #
         # using something like the Boyer-Moore Fast String Searching
-        # Algorithm; pre-compiling the search through a list of
-        # strings into something that can scan the input once to
-        # search for all N strings; realize that if we search for
-        # ['bar', 'baz'] and the input is '...foo' we need not bother
-        # rescanning until we've read three more bytes.
+        # Algorithm; realize that if we search for ['bar', 'baz'] and
+        # the input is '...foo' we need not bother rescanning until
+        # we've read three more bytes.
         #
-        # Sadly, I don't know enough about this interesting topic. /grahn
+        # Searching for several strings in one pass over the input is
+        # done by _string_automaton, see _search_automaton().
 
         for index, s in self._strings:
             if searchwindowsize is None:
@@ -1857,6 +3778,31 @@ class searcher_string(object):
         self.end = self.start + len(self.match)
         return best_index
 
+    def _search_automaton(self, buffer, freshlen, searchwindowsize):
+
+        '''This is search() for several strings. Only the fresh data is fed
+        to the automaton; the state it was left in by the previous call
+        accounts for everything before that. '''
+
+        automaton = self._automaton
+        if searchwindowsize is None:
+            windowstart = 0
+        else:
+            windowstart = max(0, len(buffer) - searchwindowsize)
+        pos = len(buffer) - freshlen
+        if pos != automaton.pos or pos < windowstart:
+            # Either this is not the buffer we were fed last time, or the
+            # old state only matters for matches starting before the window.
+            automaton.reset()
+            pos = windowstart
+        best = automaton.scan(buffer, pos, windowstart)
+        if best is None:
+            return -1
+        self.start, best_index = best
+        self.match = self._lookup[best_index]
+        self.end = self.start + len(self.match)
+        return best_index
+
 
 class searcher_re(object):
 
@@ -1878,11 +3824,17 @@ class searcher_re(object):
 
     '''
 
-    def __init__(self, patterns):
+    def __init__(self, patterns, combine=False):
 
         '''This creates an instance that searches for 'patterns' Where
         'patterns' may be a list or other sequence of compiled regular
-        expressions, or the EOF or TIMEOUT types.'''
+        expressions, or the EOF or TIMEOUT types.
+
+        If 'combine' is True the patterns are merged into one alternation,
+        so the buffer is scanned once instead of once per pattern. This is
+        quietly skipped if the patterns cannot be merged, for example
+        because they were compiled with different flags, set flags inline
+        or use backreferences. '''
 
         self.eof_index = -1
         self.timeout_index = -1
@@ -1895,6 +3847,15 @@ class searcher_re(object):
                 self.timeout_index = n
                 continue
             self._searches.append((n, s))
+        self._combined = None
+        if combine and len(self._searches) > 1:
+            self._combined = _combine_patterns(self._searches)
+        # How far back from the fresh data each pattern has to be searched
+        # again, see _searchstarts().
+        self._reaches = [_pattern_reach(s) for n, s in self._searches]
+        self._viable = [0] * len(self._searches)
+        self._settled = [0] * len(self._searches)
+        self._searched = 0
 
     def __str__(self):
 
@@ -1922,6 +3883,27 @@ class searcher_re(object):
         ss = list(zip(*ss))[1]
         return '\n'.join(ss)
 
+    def copy(self):
+
+        '''This returns a searcher for the same patterns which shares
+        everything worked out about them with this one, but not the progress
+        of a search. This is how pattern_cache hands out searchers. '''
+
+        new = copy.copy(self)
+        new._viable = [0] * len(self._searches)
+        new._settled = [0] * len(self._searches)
+        new._searched = 0
+        return new
+
+    def discard(self, size):
+
+        '''This is called when the first 'size' bytes of the buffer have been
+        thrown away since the last search, see spawn.maxbuffer. '''
+
+        self._searched = max(0, self._searched - size)
+        self._viable = [max(0, n - size) for n in self._viable]
+        self._settled = [max(0, n - size) for n in self._settled]
+
     def search(self, buffer, freshlen, searchwindowsize=None):
 
         '''This searches 'buffer' for the first occurence of one of the regular
@@ -1934,13 +3916,14 @@ class searcher_re(object):
         'start', 'end' and 'match'. Otherwise, returns -1.'''
 
         first_match = None
-        # 'freshlen' doesn't help here -- we cannot predict the
-        # length of a match, and the re module provides no help.
         if searchwindowsize is None:
-            searchstart = 0
+            windowstart = 0
         else:
-            searchstart = max(0, len(buffer) - searchwindowsize)
-        for index, s in self._searches:
+            windowstart = max(0, len(buffer) - searchwindowsize)
+        searchstarts = self._searchstarts(buffer, freshlen, windowstart)
+        if self._combined is not None:
+            return self._search_combined(buffer, min(searchstarts))
+        for (index, s), searchstart in zip(self._searches, searchstarts):
             match = s.search(buffer, searchstart)
             if match is None:
                 continue
@@ -1956,6 +3939,718 @@ class searcher_re(object):
         self.end = self.match.end()
         return best_index
 
+    def _searchstarts(self, buffer, freshlen, windowstart):
+
+        '''This returns, for each pattern, where search() has to start looking
+        in 'buffer'. The buffer up to the fresh data has already been searched
+        without a match, so a new match has to end in the fresh data, or one
+        character before it for assertions like \\b and $, or further back by
+        the width of any lookahead. A pattern that can only match so many
+        characters therefore only needs to be searched from that far back.
+
+        A pattern that can match any number of characters has to start after
+        the last character which it cannot match at all (a space, for \\S+#).
+        That position only ever moves forward, so it is kept between calls
+        while the buffer keeps growing, and only the data which has become
+        old since the last call is looked at. '''
+
+        searched = len(buffer) - freshlen
+        if searched != self._searched:
+            # This is not the buffer which was searched last time.
+            self._viable = [0] * len(self._searches)
+            self._settled = [0] * len(self._searches)
+            searched = 0
+        self._searched = len(buffer)
+
+        searchstarts = []
+        for n, (width, lookahead, lastbad) in enumerate(self._reaches):
+            if lookahead is None:
+                searchstart = 0
+            elif width is not None:
+                searchstart = max(0, searched - 1 - lookahead - width)
+            elif lastbad is None:
+                searchstart = 0
+            else:
+                settled = searched - 1 - lookahead
+                if self._settled[n] < settled:
+                    match = lastbad.match(buffer, self._settled[n], settled)
+                    if match is not None:
+                        self._viable[n] = match.end()
+                    self._settled[n] = settled
+                searchstart = self._viable[n]
+            searchstarts.append(max(searchstart, windowstart))
+        return searchstarts
+
+    def _search_combined(self, buffer, searchstart):
+
+        '''This is search() using the merged alternation. The alternation finds
+        the leftmost match, and at that position tries the patterns in list
+        order, which is the same answer the separate searches give. The
+        pattern that won is then matched on its own at that position, so
+        'match' has that pattern's own groups. '''
+
+        combined, indexes = self._combined
+        match = combined.search(buffer, searchstart)
+        if match is None:
+            return -1
+        index, s = indexes[match.lastgroup]
+        self.match = s.match(buffer, match.start())
+        self.start = self.match.start()
+        self.end = self.match.end()
+        return index
+
+
+class searcher_count(object):
+
+    '''This is a search helper for read() and read_exactly(). It does not
+    look at the data at all: it "matches" the first 'size' bytes or
+    characters as soon as there are that many in the buffer.
+
+    Attributes:
+
+        eof_index     - index of EOF, or -1
+        timeout_index - index of TIMEOUT, or -1
+
+    After a successful match by the search() method the following attributes
+    are available:
+
+        start - always 0, unless the delimiter matched
+        end   - 'size', unless the delimiter matched
+        match - None, or the match of the delimiter; the data is left for
+                expect_loop() to copy to 'after'
+
+    '''
+
+    def __init__(self, size, eof=False, delimiter=None):
+
+        '''This creates an instance that matches 'size' bytes or characters
+        at index 0. If 'eof' is True then EOF is also expected, at index 1,
+        so expect_loop() returns what is left rather than raise EOF.
+
+        'delimiter' may instead be a searcher_re for a single pattern, which
+        may be EOF or TIMEOUT, expected at index 1. As it would be by
+        expect() with '.{size}' at index 0, it only wins if it matches
+        before there are 'size' bytes or characters. '''
+
+        self.size = size
+        self.eof_index = 1 if eof else -1
+        self.timeout_index = -1
+        self._delimiter = delimiter
+        if delimiter is not None:
+            if delimiter.eof_index >= 0:
+                self.eof_index = 1
+            if delimiter.timeout_index >= 0:
+                self.timeout_index = 1
+
+    def __str__(self):
+
+        '''This returns a human-readable string that represents the state of
+        the object.'''
+
+        ss = ['searcher_count:', '    0: the first %d' % self.size]
+        if self.eof_index >= 0:
+            ss.append('    %d: EOF' % self.eof_index)
+        if self.timeout_index >= 0:
+            ss.append('    %d: TIMEOUT' % self.timeout_index)
+        if self._delimiter is not None and self._delimiter._searches:
+            ss.append('    1: re.compile(%r)' %
+                      self._delimiter._searches[0][1].pattern)
+        return '\n'.join(ss)
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+
+        '''This returns 0 and sets 'start', 'end' and 'match' if 'buffer'
+        holds at least 'size' bytes or characters, or 1 if the delimiter
+        matches. Otherwise, this returns -1. '''
+
+        if len(buffer) >= self.size:
+            self.start = 0
+            self.end = self.size
+            self.match = None
+            return 0
+        if self._delimiter is not None:
+            if self._delimiter.search(buffer, freshlen, searchwindowsize) >= 0:
+                self.start = self._delimiter.start
+                self.end = self._delimiter.end
+                self.match = self._delimiter.match
+                return 1
+        return -1
+
+
+class searcher_cache(object):
+
+    '''This is a bounded, thread-safe cache of compiled patterns and
+    searchers, shared by all spawn instances through pattern_cache. Calling
+    expect() with the same patterns again, from any session, then costs a
+    dictionary lookup instead of compiling the regular expressions and
+    working out how to search for them.
+
+    When more than 'maxsize' entries are stored the least recently used one
+    is dropped. 'maxsize' may be changed at any time; 0 turns the cache off.
+    The 'hits' and 'misses' attributes count lookups, see also info(). '''
+
+    def __init__(self, maxsize=512):
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # key -> [last use, value]; collections.OrderedDict would need
+        # Python 2.7.
+        self._entries = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def get(self, key, factory):
+
+        '''This returns the value stored for 'key', or calls factory(),
+        stores what it returns and returns that. The factory is called
+        without holding the lock, so two threads may both create a value for
+        the same key; the second one to finish wins. A 'key' which can not
+        be hashed is never stored. '''
+
+        try:
+            with self._lock:
+                entry = self._entries[key]
+                self._clock += 1
+                entry[0] = self._clock
+                self.hits += 1
+                return entry[1]
+        except KeyError:
+            pass
+        except TypeError:
+            return factory()
+        value = factory()
+        with self._lock:
+            self.misses += 1
+        self.put(key, value)
+        return value
+
+    def lookup(self, key, default=None):
+
+        '''This returns the value stored for 'key', or 'default' if there is
+        none, counting a hit or a miss. It is for callers that decide for
+        themselves what to store, with put(). '''
+
+        with self._lock:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._clock += 1
+            entry[0] = self._clock
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+
+        '''This stores 'value' for 'key', replacing what was there. '''
+
+        with self._lock:
+            if self.maxsize > 0:
+                self._clock += 1
+                self._entries[key] = [self._clock, value]
+            excess = len(self._entries) - max(self.maxsize, 0)
+            if excess > 0:
+                entries = self._entries
+                for old in heapq.nsmallest(excess, entries,
+                                           key=lambda k: entries[k][0]):
+                    del entries[old]
+
+    def clear(self):
+
+        '''This drops all entries and resets the statistics. '''
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+
+        '''This returns a dict with the 'hits', 'misses', 'size' and
+        'maxsize' of the cache. '''
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+# The re module keeps only a few hundred compiled expressions around, which
+# many sessions with different prompts soon churn through.
+pattern_cache = searcher_cache()
+
+
+_sre_repeats = [getattr(sre_parse, name) for name in
+        ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+        if hasattr(sre_parse, name)]
+
+_sre_categories = {
+    sre_parse.CATEGORY_DIGIT: r'\d', sre_parse.CATEGORY_NOT_DIGIT: r'\D',
+    sre_parse.CATEGORY_SPACE: r'\s', sre_parse.CATEGORY_NOT_SPACE: r'\S',
+    sre_parse.CATEGORY_WORD: r'\w', sre_parse.CATEGORY_NOT_WORD: r'\W',
+}
+
+def _sre_lookahead(subpattern):
+
+    '''This returns how many characters past the end of a match the
+    lookahead assertions in a parsed regular expression can look at, or None
+    if there is no limit. '''
+
+    lookahead = 0
+    for op, av in subpattern:
+        if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if av[0] == 1:
+                width = av[1].getwidth()[1]
+                if width >= sre_parse.MAXREPEAT:
+                    return None
+                lookahead = max(lookahead, width)
+            continue
+        todo = [av]
+        while todo:
+            item = todo.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                nested = _sre_lookahead(item)
+                if nested is None:
+                    return None
+                lookahead = max(lookahead, nested)
+            elif isinstance(item, (tuple, list)):
+                todo.extend(item)
+    return lookahead
+
+def _sre_alphabet(subpattern, flags, pieces):
+
+    '''This appends to 'pieces' a regular expression for each character class
+    in a parsed regular expression which can consume input. Assertions
+    consume nothing and are left out. This returns False if any character
+    at all can be consumed. '''
+
+    char = chr if PY3 else unichr  # analysis:ignore
+    for op, av in subpattern:
+        if op is sre_parse.LITERAL:
+            pieces.append(re.escape(char(av)))
+        elif op is sre_parse.NOT_LITERAL:
+            pieces.append('[^%s]' % re.escape(char(av)))
+        elif op is sre_parse.ANY:
+            if flags & re.DOTALL:
+                return False
+            pieces.append('[^\\n]')
+        elif op is sre_parse.IN:
+            items = []
+            negate = ''
+            for item_op, item_av in av:
+                if item_op is sre_parse.NEGATE:
+                    negate = '^'
+                elif item_op is sre_parse.LITERAL:
+                    items.append(re.escape(char(item_av)))
+                elif item_op is sre_parse.RANGE:
+                    items.append('%s-%s' % (re.escape(char(item_av[0])),
+                                            re.escape(char(item_av[1]))))
+                elif (item_op is sre_parse.CATEGORY and
+                        item_av in _sre_categories):
+                    items.append(_sre_categories[item_av])
+                else:
+                    return False
+            if not items:
+                return False
+            pieces.append('[%s%s]' % (negate, ''.join(items)))
+        elif op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT,
+                    sre_parse.GROUPREF):
+            # A backreference consumes what its group did.
+            continue
+        elif op is sre_parse.SUBPATTERN:
+            if not _sre_alphabet(av[-1], flags, pieces):
+                return False
+        elif op in _sre_repeats:
+            if not _sre_alphabet(av[2], flags, pieces):
+                return False
+        elif op is sre_parse.BRANCH:
+            for branch in av[1]:
+                if not _sre_alphabet(branch, flags, pieces):
+                    return False
+        elif op is sre_parse.GROUPREF_EXISTS:
+            for branch in av[1:]:
+                if branch is not None and not _sre_alphabet(branch, flags,
+                                                            pieces):
+                    return False
+        elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+            if not _sre_alphabet(av, flags, pieces):
+                return False
+        else:
+            return False
+    return True
+
+def _pattern_reach(pattern):
+
+    '''This works out how far a compiled pattern can reach, for
+    searcher_re._searchstarts(). This returns (width, lookahead, lastbad):
+    the most characters a match can span, or None if there is no limit;
+    how far past the end of a match its lookahead assertions can look, or
+    None if there is no limit; and, for a pattern of unlimited width, a
+    regular expression that .match()es up to the last character the pattern
+    can not consume, or None if it can consume any character. '''
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+        lookahead = _sre_lookahead(parsed)
+        width = parsed.getwidth()[1]
+    except Exception:
+        return None, None, None
+    if width < sre_parse.MAXREPEAT:
+        return width, lookahead, None
+    pieces = []
+    if lookahead is None or not _sre_alphabet(parsed, pattern.flags, pieces):
+        return None, lookahead, None
+    source = '.*(?!%s).' % '|'.join(pieces)
+    if isinstance(pattern.pattern, bytes):
+        source = source.encode('latin-1')
+    flags = pattern.flags & ~(re.VERBOSE | re.MULTILINE) | re.DOTALL
+    try:
+        return None, lookahead, re.compile(source, flags)
+    except (re.error, UnicodeError):
+        return None, lookahead, None
+
+
+# Inline flags such as (?i) apply to the whole expression, so a pattern which
+# sets them cannot be dropped into an alternation with other patterns.
+_inline_flags = re.compile(r'\(\?[aiLmsux]+\)')
+
+def _sre_opcodes(subpattern):
+
+    '''This yields the opcode of every item in a parsed regular expression,
+    including those nested in groups, branches, repeats and assertions. '''
+
+    for op, av in subpattern:
+        yield op
+        todo = [av]
+        while todo:
+            item = todo.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                for nested in _sre_opcodes(item):
+                    yield nested
+            elif isinstance(item, (tuple, list)):
+                todo.extend(item)
+
+def _combine_patterns(searches):
+
+    '''This merges the (index, compiled pattern) pairs of a searcher_re into
+    one alternation with a named group around each pattern. This returns
+    (compiled alternation, {group name: (index, pattern)}), or None if the
+    patterns cannot be merged without changing what they match. '''
+
+    flags = set(s.flags for n, s in searches)
+    types = set(type(s.pattern) for n, s in searches)
+    if len(flags) != 1 or len(types) != 1:
+        return None
+    flags = flags.pop()
+    if flags & re.VERBOSE:
+        return None
+    names = set()
+    for n, s in searches:
+        source = s.pattern
+        if isinstance(source, bytes):
+            source = source.decode('latin-1')
+        if _inline_flags.search(source):
+            return None
+        try:
+            opcodes = set(_sre_opcodes(sre_parse.parse(s.pattern, flags)))
+        except Exception:
+            return None
+        if (sre_parse.GROUPREF in opcodes or
+                sre_parse.GROUPREF_EXISTS in opcodes):
+            return None
+        names.update(s.groupindex)
+
+    indexes = {}
+    alternatives = []
+    for n, s in searches:
+        name = '_pexpect_%d' % n
+        if name in names:
+            return None
+        indexes[name] = (n, s)
+        alternatives.append('(?P<%s>' % name)
+        alternatives.append(s.pattern)
+        alternatives.append(')|')
+    alternatives.pop()
+    alternatives.append(')')
+    if types.pop() is bytes:
+        alternatives = [a if isinstance(a, bytes) else a.encode('ascii')
+                        for a in alternatives]
+    try:
+        combined = re.compile(alternatives[1][:0].join(alternatives), flags)
+    except re.error:
+        return None
+    return combined, indexes
+
+
+def _close_fds(keep=()):
+
+    '''This closes every file descriptor from 3 up, except those in 'keep',
+    which are made inheritable. It is used in the child before exec. Rather
+    than trying to close each descriptor up to RLIMIT_NOFILE, which may be
+    very large, it closes ranges with os.closerange(), and where
+    /proc/self/fd lists the open descriptors it stops after the highest. '''
+
+    max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if max_fd == resource.RLIM_INFINITY:
+        max_fd = os.sysconf('SC_OPEN_MAX')
+    try:
+        open_fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except (OSError, ValueError):
+        pass
+    else:
+        max_fd = min(max_fd, max(open_fds + [2]) + 1)
+    start = 3
+    for fd in sorted(keep) + [max_fd]:
+        if fd < start:
+            continue
+        os.closerange(start, min(fd, max_fd))
+        if fd < max_fd and hasattr(os, 'set_inheritable'):
+            try:
+                os.set_inheritable(fd, True)
+            except OSError:
+                pass
+        start = fd + 1
+
+
+def _setwinsize(fd, rows, cols):
+
+    '''This sets the terminal window size of the tty 'fd'. See
+    spawn.setwinsize(). '''
+
+    # Some very old platforms have a bug that causes the value for
+    # termios.TIOCSWINSZ to be truncated. There was a hack here to work
+    # around this, but it caused problems with newer platforms so has been
+    # removed. For details see https://github.com/pexpect/pexpect/issues/39
+    TIOCSWINSZ = getattr(termios, 'TIOCSWINSZ', -2146929561)
+    # Note, assume ws_xpixel and ws_ypixel are zero.
+    s = struct.pack('HHHH', rows, cols, 0, 0)
+    fcntl.ioctl(fd, TIOCSWINSZ, s)
+
+
+def _exec_child(command, args, env, cwd, ignore_sighup, pass_fds):
+
+    '''This finishes setting up a forked child, whose stdin, stdout and
+    stderr are already the pty, and execs the command. '''
+
+    # Do not allow child to inherit open file descriptors from parent.
+    _close_fds(pass_fds)
+
+    if ignore_sighup:
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    if cwd is not None:
+        os.chdir(cwd)
+    if env is None:
+        os.execv(command, args)
+    else:
+        os.execvpe(command, args, env)
+
+
+def _send_fds(sock, data, fds):
+
+    '''This sends a message over a Unix socket, passing the descriptors
+    in 'fds' along with it. '''
+
+    ancdata = []
+    if fds:
+        ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                        array.array('i', fds)))
+    sock.sendmsg([data], ancdata)
+
+
+def _recv_fds(sock, size, maxfds):
+
+    '''This receives a message of up to 'size' bytes over a Unix socket,
+    and up to 'maxfds' descriptors passed along with it. It returns the
+    message, which is empty at EOF, and a list of the descriptors. If the
+    message or the descriptors did not fit, the descriptors are closed and
+    ValueError is raised. '''
+
+    fds = array.array('i')
+    data, ancdata, flags, addr = sock.recvmsg(
+            size, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, kind, fd_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+    if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+        for fd in fds:
+            os.close(fd)
+        raise ValueError('The message was truncated.')
+    return data, list(fds)
+
+
+def _read_exit_status(fd):
+
+    '''This reads the wait status and resource usage a spawn_server sends
+    once a child exits, blocking until it does. '''
+
+    data = os.read(fd, 4096)
+    if not data:
+        raise ExceptionPexpect('The spawn server exited without reporting ' +
+                               'the exit status of the child.')
+    return pickle.loads(data)
+
+
+def _spawn_server_main(sock):
+
+    '''This is the spawn_server process. It starts children as asked on
+    'sock' until that is closed, and sends the wait status of each child to
+    its exit socket, until the last one has exited. '''
+
+    # Keep terminal signals meant for the parent away from the server.
+    os.setsid()
+    _close_fds([sock.fileno()])
+    wakeup_read, wakeup_write = os.pipe()
+    for fd in (wakeup_read, wakeup_write):
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    children = {}
+    while sock is not None or children:
+        fds = [wakeup_read]
+        if sock is not None:
+            fds.append(sock.fileno())
+        try:
+            r = select.select(fds, [], [])[0]
+        except (select.error, IOError, OSError):
+            err = sys.exc_info()[1]
+            if err.args[0] != errno.EINTR:
+                raise
+            r = [wakeup_read]
+        if wakeup_read in r:
+            try:
+                while os.read(wakeup_read, 512):
+                    pass
+            except OSError:
+                pass
+        while children:
+            try:
+                pid, status, rusage = _wait4(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid == 0:
+                break
+            exit_sock = children.pop(pid, None)
+            if exit_sock is not None:
+                try:
+                    exit_sock.send(pickle.dumps((status, rusage)))
+                except (IOError, OSError):
+                    pass
+                exit_sock.close()
+        if sock is None or sock.fileno() not in r:
+            continue
+        fds = passed = []
+        try:
+            request, passed = _recv_fds(sock, _spawn_request_size,
+                                        _spawn_request_fds)
+            if not request:
+                sock.close()
+                sock = None
+                continue
+            pid, fds = _spawn_server_fork(pickle.loads(request), passed,
+                                          children)
+            reply = (pid, None)
+        except (IOError, OSError):
+            # The parent went away in the middle of a request.
+            sock.close()
+            sock = None
+            continue
+        except Exception:
+            # A bad request must not take the server down: the children it
+            # already started still need their exit status reported.
+            err = sys.exc_info()[1]
+            reply = (None, '%s: %s' % (type(err).__name__, err))
+        try:
+            _send_fds(sock, pickle.dumps(reply), fds)
+        except (IOError, OSError):
+            sock.close()
+            sock = None
+        finally:
+            for fd in fds + passed:
+                os.close(fd)
+
+
+# The largest request a spawn_server accepts, and the most pass_fds.
+_spawn_request_size = 1 << 18
+_spawn_request_fds = 256
+
+
+def _spawn_server_fork(request, passed, children):
+
+    '''This starts a child in the spawn_server, and returns its pid and
+    the descriptors to pass back: the pty and the other end of the socket
+    the wait status will be sent to. '''
+
+    command, args, env, cwd, ignore_sighup, pass_fds = request
+    exit_sock, their_exit_sock = socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_SEQPACKET)
+    try:
+        pid, child_fd = pty.fork()
+    except:
+        exit_sock.close()
+        their_exit_sock.close()
+        raise
+    if pid == 0:
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                _setwinsize(pty.STDOUT_FILENO, 24, 80)
+            except (IOError, OSError):
+                # See spawn._spawn().
+                pass
+            # Move the passed descriptors out of the way, then to the
+            # numbers they had in the parent.
+            top = max(list(pass_fds) + passed + [2]) + 1
+            moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, top) for fd in passed]
+            for fd, target in zip(moved, pass_fds):
+                os.dup2(fd, target)
+            _exec_child(command, args, env, cwd, ignore_sighup, pass_fds)
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(1)
+    children[pid] = exit_sock
+    fd = their_exit_sock.detach()
+    return pid, [child_fd, fd]
+
+
+def _inherited_fds(keep=()):
+
+    '''This returns the descriptors from 3 up, other than those in 'keep',
+    that a child would inherit across exec, where /proc/self/fd lists the
+    open descriptors, or else an empty list. '''
+
+    try:
+        open_fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except (OSError, ValueError):
+        return []
+    fds = []
+    for fd in sorted(open_fds):
+        if fd < 3 or fd in keep:
+            continue
+        try:
+            if os.get_inheritable(fd):
+                fds.append(fd)
+        except OSError:
+            # The descriptor listdir() used, now closed.
+            pass
+    return fds
+
+
+# posix_spawn() can only give the child a controlling tty where opening the
+# tty after setsid() does so, which is the case on Linux.
+_can_posix_spawn = (hasattr(os, 'posix_spawn') and
+                    hasattr(os, 'POSIX_SPAWN_OPEN') and
+                    sys.platform.startswith('linux'))
+
 
 def which(filename):
     '''This takes a given filename; tries to find it in the environment path;
@@ -1980,62 +4675,83 @@ def which(filename):
     return None
 
 
+# Where _cached_which() found commands before.
+which_cache = searcher_cache(maxsize=256)
+
+
+def _cached_which(filename):
+
+    '''This is which(), but remembers where it found commands in
+    which_cache. A result is used again while PATH, the modification times
+    of the directories in it and, where PATH has relative directories, the
+    current directory are the same, and the file is still executable. Those
+    checks need one stat() per directory. A command that was not found is
+    not remembered. Call which_cache.clear() to forget everything. '''
+
+    if 'PATH' not in os.environ or os.environ['PATH'] == '':
+        p = os.defpath
+    else:
+        p = os.environ['PATH']
+    pathlist = p.split(os.pathsep)
+    stamps = []
+    for path in pathlist:
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamps.append(None)
+        else:
+            stamps.append(getattr(st, 'st_mtime_ns', st.st_mtime))
+    key = ('which', filename, p, tuple(stamps))
+    if not all(os.path.isabs(path) for path in pathlist):
+        key += (os.getcwd(),)
+    result = which_cache.lookup(key)
+    if result is not None and os.access(result, os.X_OK):
+        return result
+    result = which(filename)
+    if result is not None:
+        which_cache.put(key, result)
+    return result
+
+
+# One token of a command line for split_command_line(): an escaped character
+# (or a trailing backslash), a quoted string (which may be unterminated),
+# whitespace, or a run of other characters.
+_command_line_token = re.compile(r'''
+    \\(?P<escaped>.)?
+  | '(?P<single>[^']*)'?
+  | "(?P<double>[^"]*)"?
+  | (?P<space>\s+)
+  | (?P<plain>[^\\'"\s]+)
+''', re.DOTALL | re.VERBOSE)
+
+# Parsed command lines, as spawn is often given the same ones.
+_command_line_cache = searcher_cache(maxsize=128)
+
+
 def split_command_line(command_line):
 
     '''This splits a command line into a list of arguments. It splits arguments
     on spaces, but handles embedded quotes, doublequotes, and escaped
-    characters. It's impossible to do this with a regular expression, so I
-    wrote a little state machine to parse the command line. '''
+    characters. A backslash escapes any character outside quotes; inside
+    quotes every character up to the closing quote is taken as it is. '''
 
-    arg_list = []
-    arg = ''
-
-    # Constants to name the states we can be in.
-    state_basic = 0
-    state_esc = 1
-    state_singlequote = 2
-    state_doublequote = 3
-    # The state when consuming whitespace between commands.
-    state_whitespace = 4
-    state = state_basic
-
-    for c in command_line:
-        if state == state_basic or state == state_whitespace:
-            if c == '\\':
-                # Escape the next character
-                state = state_esc
-            elif c == r"'":
-                # Handle single quote
-                state = state_singlequote
-            elif c == r'"':
-                # Handle double quote
-                state = state_doublequote
-            elif c.isspace():
-                # Add arg to arg_list if we aren't in the middle of whitespace.
-                if state == state_whitespace:
-                    # Do nothing.
-                    None
-                else:
-                    arg_list.append(arg)
-                    arg = ''
-                    state = state_whitespace
-            else:
-                arg = arg + c
-                state = state_basic
-        elif state == state_esc:
-            arg = arg + c
-            state = state_basic
-        elif state == state_singlequote:
-            if c == r"'":
-                state = state_basic
-            else:
-                arg = arg + c
-        elif state == state_doublequote:
-            if c == r'"':
-                state = state_basic
-            else:
-                arg = arg + c
+    return list(_command_line_cache.get(command_line,
+            lambda: tuple(_split_command_line(command_line))))
 
+
+def _split_command_line(command_line):
+
+    arg_list = []
+    arg = []
+    for token in _command_line_token.finditer(command_line):
+        kind = token.lastgroup
+        if kind == 'space':
+            # Whitespace ends an argument, even an empty one.
+            arg_list.append(''.join(arg))
+            arg = []
+        elif kind is not None:
+            arg.append(token.group(kind))
+    arg = ''.join(arg)
     if arg != '':
         arg_list.append(arg)
     return arg_list
@@ -76,6 +76,7 @@ class fdspawn (spawn):
         os.close(self.child_fd)
         self.child_fd = -1
         self.closed = True
+        self._close_poller()
 
     def isalive (self):
         '''This checks if the file descriptor is still valid. If :func:`os.fstat`
@@ -34,6 +34,30 @@ class SplitCommandLineTestCase(PexpectTestCase.PexpectTestCase):
         assert len(pexpect.split_command_line(r'one\"one')) == 1
         assert len(pexpect.split_command_line(r'This\' is a\'\ test')) == 3
 
+    def testSplitContents(self):
+        split = pexpect.split_command_line
+        self.assertEqual(split(r'one\ one'), ['one one'])
+        self.assertEqual(split(r'one\"one'), ['one"one'])
+        self.assertEqual(split(r"This\' is a\'\ test"),
+                         ["This'", 'is', "a' test"])
+        self.assertEqual(split('in"side quo"tes'), ['inside quotes'])
+        self.assertEqual(split('"a\\"b'), ['a\\b'])
+        self.assertEqual(split("mixed'single\"double'\"x'y\""),
+                         ['mixedsingle"doublex\'y'])
+        self.assertEqual(split('a "" b'), ['a', '', 'b'])
+        self.assertEqual(split(' lead'), ['', 'lead'])
+        self.assertEqual(split('trail \t\n'), ['trail'])
+        self.assertEqual(split('unterminated "quote here'),
+                         ['unterminated', 'quote here'])
+        self.assertEqual(split('back\\'), ['back'])
+        self.assertEqual(split('x\\\ny'), ['x\ny'])
+
+    def testSplitCached(self):
+        # Each call returns a list of its own, even when cached.
+        args = pexpect.split_command_line('ls -l')
+        args[0] = '/bin/ls'
+        self.assertEqual(pexpect.split_command_line('ls -l'), ['ls', '-l'])
+
 if __name__ == '__main__':
     unittest.main()
 
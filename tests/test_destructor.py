@@ -22,7 +22,9 @@ import pexpect
 import unittest
 from . import PexpectTestCase
 import gc
+import os
 import platform
+import subprocess
 import time
 
 class TestCaseDestructor(PexpectTestCase.PexpectTestCase):
@@ -76,6 +78,79 @@ class TestCaseDestructor(PexpectTestCase.PexpectTestCase):
 
         assert (fd_t1 == fd_t2 == fd_t3), "pty file descriptors not properly garbage collected (fd_t1,fd_t2,fd_t3)=(%s,%s,%s)" % (str(fd_t1),str(fd_t2),str(fd_t3))
 
+    def test_destructor_does_not_wait(self):
+        if not hasattr(pexpect.weakref, 'finalize'):
+            return 'SKIP'
+        # The child ignores SIGHUP, so close() would wait for it.
+        p = pexpect.spawn('sh', ['-c', 'trap "" HUP; echo ready; exec sleep 30'])
+        p.expect('ready')
+        p.delayafterclose = 0.5
+        pid = p.pid
+        start = time.time()
+        p = None
+        gc.collect()
+        assert time.time() - start < 0.1
+        # The child is then terminated in the background, once the
+        # delayafterclose set above has passed.
+        time.sleep(0.2)
+        os.kill(pid, 0)
+        self._wait_for_orphans()
+        self.assertRaises(OSError, os.kill, pid, 0)
+
+        # Many at once, as when the collector finds a lot of cycles.
+        for n in range(20):
+            p = pexpect.spawn('cat')
+            p.cycle = p
+        p = None
+        gc.collect()
+        self._wait_for_orphans()
+
+    def test_destructor_after_close_all(self):
+        if not hasattr(pexpect.weakref, 'finalize'):
+            return 'SKIP'
+        p = pexpect.spawn('cat')
+        pexpect.close_all([p])
+        # This may well get the descriptor the pty had.
+        r, w = os.pipe()
+        p = None
+        gc.collect()
+        os.fstat(r)
+        os.close(r)
+        os.close(w)
+
+    def test_exit_terminates_child(self):
+        if not hasattr(pexpect.weakref, 'finalize'):
+            return 'SKIP'
+        # Left open when the interpreter exits. As from Python 3.12, no
+        # thread can be started by then, so none is allowed here at all.
+        script = '\n'.join([
+            'import sys, threading, pexpect',
+            'def start(thread):',
+            '    raise RuntimeError("no thread at exit")',
+            'threading.Thread.start = start',
+            'p = pexpect.spawn("sh", ["-c", '
+            '"trap \'\' HUP; echo ready; exec sleep 30"])',
+            'p.expect("ready")',
+            'sys.stdout.write("%d\\n" % p.pid)',
+        ])
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.abspath(pexpect.__file__)))
+        start = time.time()
+        proc = subprocess.Popen([self.PYTHONBIN, '-c', script], env=env,
+                                stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        assert time.time() - start < 5, time.time() - start
+        self.assertEqual(proc.returncode, 0)
+        pid = int(output)
+        self.assertRaises(OSError, os.kill, pid, 0)
+
+    def _wait_for_orphans(self):
+        deadline = time.time() + 5
+        while len(pexpect._orphans) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(pexpect._orphans), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -348,11 +348,47 @@ class ExpectTestCase (PexpectTestCase.PexpectTestCase):
                 ).replace(b'\r', b'\n').replace(b'\n\n', b'\n').rstrip()
         assert the_old_way == the_new_way, hex_diff(the_old_way, the_new_way)
 
+    def test_expect_eof_long_output(self):
+        '''Reading a lot of output before the match should not take
+        quadratic time, and before/after/buffer should still be strings.
+        '''
+        p = pexpect.spawn('seq 1 200000', timeout=30)
+        p.expect(b'100000\r\n')
+        self.assertEqual(type(p.before), bytes)
+        self.assertEqual(type(p.after), bytes)
+        self.assertEqual(type(p.buffer), bytes)
+        assert p.before.endswith(b'\r\n99999\r\n'), p.before[-20:]
+        p.expect(pexpect.EOF)
+        self.assertEqual(type(p.before), bytes)
+        self.assertEqual(p.before.count(b'\r\n'), 100000)
+
     def test_expect_timeout (self):
         p = pexpect.spawn('cat', timeout=5)
         p.expect(pexpect.TIMEOUT) # This tells it to wait for timeout.
         self.assertEqual(p.after, pexpect.TIMEOUT)
 
+    def test_maxbuffer(self):
+        '''Unmatched data past maxbuffer is thrown away, and only the end of
+        'before' is kept past maxbefore.
+        '''
+        p = pexpect.spawn('seq 1 100000', maxread=4096)
+        p.maxbuffer = 1000
+        p.maxbefore = 20
+        others = [('x%d' % n).encode('ascii') for n in range(10)]
+        # the patterns still match across the point where data is dropped
+        self.assertEqual(p.expect([b'\r\n50000\r\n', b'never' * 10] + others),
+                         0)
+        assert p.before.endswith(b'\r\n49999'), p.before
+        self.assertEqual(len(p.before), 20)
+        self.assertEqual(p.expect_exact([b'\r\n60000\r\n'] + others), 0)
+        self.assertEqual(p.before[-7:], b'\r\n59999')
+        p.expect(pexpect.EOF)
+        self.assertEqual(len(p.before), 20)
+        self.assertEqual(p.before[-8:], b'100000\r\n'[-8:])
+        total = len(''.join('%d\r\n' % n for n in range(1, 100001)))
+        self.assertEqual(p.discarded + 3 * 20 + 2 * len(b'\r\n50000\r\n'),
+                         total)
+
     def test_unexpected_eof (self):
         p = pexpect.spawn('ls -l /bin')
         try:
@@ -437,6 +473,14 @@ class ExpectTestCase (PexpectTestCase.PexpectTestCase):
         p.expect = p.expect_exact
         self._ordering(p)
 
+    def test_ordering_combined(self):
+        '''Like test_ordering(), but with all patterns searched for in one
+        pass over the input.
+        '''
+        p = pexpect.spawn(self.PYTHONBIN)
+        p.combine_patterns = True
+        self._ordering(p)
+
     def _greed(self, expect):
         # End at the same point: the one with the earliest start should win
         self.assertEqual(expect([b'3, 4', b'2, 3, 4']), 1)
@@ -462,6 +506,11 @@ class ExpectTestCase (PexpectTestCase.PexpectTestCase):
         p = pexpect.spawn(self.PYTHONBIN + ' list100.py', maxread=1)
         self._greed_read1(p.expect)
 
+    def test_greed_combined(self):
+        p = pexpect.spawn(self.PYTHONBIN + ' list100.py')
+        p.combine_patterns = True
+        self._greed(p.expect)
+
     def test_greed_exact(self):
         p = pexpect.spawn(self.PYTHONBIN + ' list100.py')
         self._greed(p.expect_exact)
@@ -23,6 +23,7 @@ from pexpect import fdpexpect
 import unittest
 from . import PexpectTestCase
 import os
+import tempfile
 
 class ExpectTestCase(PexpectTestCase.PexpectTestCase):
     def setUp(self):
@@ -45,6 +46,24 @@ class ExpectTestCase(PexpectTestCase.PexpectTestCase):
         s.expect (pexpect.EOF)
         self.assertEqual(s.before, b' END\n')
 
+    def test_read_binary (self):
+        fd, name = tempfile.mkstemp()
+        data = bytes(bytearray(range(256))) * 4096
+        os.write(fd, data)
+        os.close(fd)
+        try:
+            s = fdpexpect.fdspawn(os.open(name, os.O_RDONLY), maxread=65536)
+            self.assertEqual(s.read(10), data[:10])
+            self.assertEqual(s.read_exactly(len(data) - 20), data[10:-10])
+            buf = bytearray(16)
+            self.assertEqual(s.readinto(memoryview(buf)[4:]), 10)
+            self.assertEqual(bytes(buf[4:14]), data[-10:])
+            self.assertRaises(pexpect.EOF, s.read_exactly, 1)
+            self.assertEqual(s.readinto(buf), 0)
+            s.close()
+        finally:
+            os.remove(name)
+
     def test_fd_isalive (self):
         fd = os.open ('TESTDATA.txt', os.O_RDONLY)
         s = fdpexpect.fdspawn(fd)
@@ -21,6 +21,7 @@ PEXPECT LICENSE
 import pexpect
 import unittest
 import signal
+import os
 import sys
 import time
 from . import PexpectTestCase
@@ -114,6 +115,184 @@ class IsAliveTestCase(PexpectTestCase.PexpectTestCase):
         if p.isalive():
             self.fail ('Second call. Child process is not dead. It should be.')
 
+    def test_close_waits_only_until_exit(self):
+        '''close() and terminate() wait for the child to exit, at most for
+        delayafterclose and delayafterterminate. '''
+        p = pexpect.spawn('cat')
+        p.delayafterclose = 5
+        start = time.time()
+        p.close()
+        assert time.time() - start < 2, time.time() - start
+        assert not p.isalive()
+
+        p = pexpect.spawn('sleep 30', ignore_sighup=False)
+        p.delayafterterminate = 5
+        start = time.time()
+        assert p.terminate()
+        assert time.time() - start < 2, time.time() - start
+        self.assertEqual(p.signalstatus, signal.SIGHUP)
+
+    def test_close_all(self):
+        '''close_all() terminates many children in about the time it takes
+        to terminate one. '''
+        sessions = [pexpect.spawn('sleep 30') for n in range(20)]
+        sessions.append(pexpect.spawn('cat'))
+        start = time.time()
+        results = pexpect.close_all(sessions)
+        assert time.time() - start < 2, time.time() - start
+        self.assertEqual(results[:-1], [(None, signal.SIGINT)] * 20)
+        assert results[-1][0] is not None, results[-1]
+        for p in sessions:
+            assert p.closed
+            assert not p.isalive()
+
+        # A class with its own close() is closed with it.
+        closed = []
+        class logging_spawn(pexpect.spawn):
+            def close(self, force=True):
+                closed.append(self)
+                pexpect.spawn.close(self, force)
+        p = logging_spawn('cat')
+        assert pexpect.close_all([p])[0] is not None
+        self.assertEqual(closed, [p])
+
+    def test_reaper(self):
+        '''With start_reaper(), children are reaped as soon as they exit,
+        and isalive() copes with the child being reaped elsewhere. '''
+        reaper = pexpect.start_reaper()
+        try:
+            assert pexpect.start_reaper() is reaper
+            p = pexpect.spawn('sh', ['-c', 'exit 5'])
+            assert reaper.wait(p.pid, timeout=5) is not None
+            assert not p.isalive()
+            self.assertEqual(p.exitstatus, 5)
+            assert reaper.status(p.pid) is None
+
+            p = pexpect.spawn('cat')
+            assert p.isalive()
+            p.sendeof()
+            p.expect(pexpect.EOF)
+            assert not p.isalive()
+
+            p = pexpect.spawn('true')
+            try:
+                os.waitpid(p.pid, 0)
+            except OSError:
+                # The reaper was first.
+                pass
+            reaper.wait(p.pid, timeout=5)
+            assert not p.isalive()
+            p.close()
+        finally:
+            pexpect.stop_reaper()
+        p = pexpect.spawn('sh', ['-c', 'exit 6'])
+        assert p._reaper is None
+        p.expect(pexpect.EOF)
+        assert not p.isalive()
+        self.assertEqual(p.exitstatus, 6)
+
+    def test_reaper_kill(self):
+        '''The reaper watches the pidfd of the spawn rather than opening
+        another, and does not signal a pid it has already reaped. '''
+        reaper = pexpect.start_reaper()
+        try:
+            p = pexpect.spawn('cat')
+            fd = p._pidfd
+            if fd is not None:
+                self.assertEqual(reaper._children[p.pid], (fd, False))
+            p.kill(signal.SIGKILL)
+            assert reaper.wait(p.pid, timeout=5) is not None
+            assert not reaper.kill(p.pid, signal.SIGKILL)
+            assert not p.isalive()
+            self.assertEqual(p.signalstatus, signal.SIGKILL)
+            if fd is not None:
+                self.assertRaises(OSError, os.fstat, fd)
+
+            # Closed before the reaper has the child, the pidfd is left to
+            # the reaper to close.
+            p = pexpect.spawn('sh', ['-c', 'trap "" HUP; echo ready; '
+                                           'exec sleep 0.5'])
+            p.expect('ready')
+            fd = p._pidfd
+            p.delayafterclose = 0
+            p.delayafterterminate = 0
+            p._close_pty()
+            p._close_pidfd()
+            if fd is not None:
+                self.assertEqual(reaper._children[p.pid], (fd, True))
+            assert reaper.wait(p.pid, timeout=5) is not None
+            if fd is not None:
+                self.assertRaises(OSError, os.fstat, fd)
+        finally:
+            pexpect.stop_reaper()
+
+    def test_resource_usage(self):
+        '''The resource usage of the child is kept, and passed to the
+        functions in exit_hooks. '''
+        if not hasattr(os, 'wait4'):
+            return 'SKIP'
+        summaries = []
+        hook = lambda child, summary: summaries.append((child, summary))
+        pexpect.exit_hooks.append(hook)
+        try:
+            p = pexpect.spawn('sh', ['-c', 'exit 3'])
+            assert p.resource_usage() is None
+            p.expect(pexpect.EOF)
+            p.close()
+        finally:
+            pexpect.exit_hooks.remove(hook)
+        self.assertEqual(p.exitstatus, 3)
+        assert p.rusage is not None
+        summary = p.resource_usage()
+        self.assertEqual(summaries, [(p, summary)])
+        self.assertEqual(summary['exitstatus'], 3)
+        self.assertEqual(summary['user_time'], p.rusage.ru_utime)
+        assert summary['max_rss'] > 0, summary
+        assert summary['wall_time'] >= 0, summary
+
+    def test_isalive_pidfd(self):
+        '''Where the child has a pidfd, isalive() only calls waitpid() once
+        the child has exited. '''
+        if not hasattr(os, 'pidfd_open'):
+            return 'SKIP'
+        calls = []
+        wait4 = pexpect._wait4
+        def counting_wait4(pid, options):
+            calls.append(options)
+            return wait4(pid, options)
+        p = pexpect.spawn('cat')
+        pexpect._wait4 = counting_wait4
+        try:
+            for n in range(100):
+                assert p.isalive()
+            self.assertEqual(calls, [])
+            p.sendeof()
+            p.expect(pexpect.EOF)
+            assert not p.isalive()
+            self.assertEqual(calls, [0])
+        finally:
+            pexpect._wait4 = wait4
+        self.assertEqual(p.exitstatus, 0)
+        assert p._pidfd is None
+
+    def test_eof_while_pty_held(self):
+        '''EOF is seen as soon as the child exits, even if something it
+        started still holds the pty open. '''
+        for pidfd in (True, False):
+            p = pexpect.spawn('sh', ['-c', 'sleep 1; sleep 8 & echo hi'],
+                              timeout=5)
+            if not pidfd:
+                # Then the exit is only looked for before waiting.
+                p._close_pidfd()
+                time.sleep(1.5)
+            start = time.time()
+            p.expect(pexpect.EOF)
+            assert time.time() - start < 3, time.time() - start
+            self.assertEqual(p.before, b'hi\r\n')
+            assert not p.isalive()
+            self.assertEqual(p.exitstatus, 0)
+            p.close()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -26,6 +26,10 @@ import sys
 import tempfile
 import re
 import signal
+import fcntl
+import io
+import select
+import resource
 import time
 
 # the program cat(1) may display ^D\x08\x08 when \x04 (EOF, Ctrl-D) is sent
@@ -49,6 +53,21 @@ class TestCaseMisc(PexpectTestCase.PexpectTestCase):
         remaining = child.read().replace(_CAT_EOF, b'')
         self.assertEqual(remaining, b'abc\r\n')
 
+    def test_read_delimiter(self):
+        child = pexpect.spawn('sh', ['-c', 'echo abc; echo 123; sleep 5'])
+        child.delimiter = b'\\d'
+        # the delimiter ends the read before 20 bytes arrive
+        self.assertEqual(child.read(20), b'abc\r\n')
+        self.assertEqual(child.match.group(), b'1')
+        # but not once there are enough
+        self.assertEqual(child.read(1), b'2')
+        self.assertEqual(child.match, b'2')
+        # TIMEOUT as the delimiter returns what arrived in time
+        child.delimiter = pexpect.TIMEOUT
+        child.timeout = 0.5
+        self.assertEqual(child.read(10), b'3\r\n')
+        child.close()
+
     def test_readline (self):
         '''See the note in test_readlines() for an explaination as to why
         I allow line3 and line4 to return multiple patterns.
@@ -128,6 +147,49 @@ class TestCaseMisc(PexpectTestCase.PexpectTestCase):
         assert not child.isalive(), child.isalive()
         assert child.exitstatus == 0, child.exitstatus
 
+    def test_iter_lines(self):
+        child = pexpect.spawn('seq 1 5000', maxread=4096)
+        it = iter(child)
+        self.assertEqual(next(it), b'1\r\n')
+        self.assertEqual(child.before, b'1')
+        self.assertEqual(child.after, b'\r\n')
+        self.assertEqual(child.match.group(), b'\r\n')
+        # the buffer holds everything not handed out yet, so readline()
+        # and expect() can be mixed with iterating
+        self.assertEqual(next(it), b'2\r\n')
+        self.assertEqual(child.readline(), b'3\r\n')
+        self.assertEqual(child.expect_exact(b'10\r\n'), 0)
+        self.assertEqual(next(it), b'11\r\n')
+        lines = list(it)
+        self.assertEqual(len(lines), 5000 - 11)
+        self.assertEqual(lines[-1], b'5000\r\n')
+        self.assertEqual(child.readline(), b'')
+
+        child = pexpect.spawnu('sh', ['-c', u'echo caf\xe9; printf no-newline'])
+        self.assertEqual(child.readlines(), [u'caf\xe9\r\n', u'no-newline'])
+
+        # the delimiter is a pattern, as for expect(), and can end a line
+        # before a newline already in the buffer
+        command = "printf 'one\\ntwo-END7\\nthree\\n'; sleep 5"
+        child = pexpect.spawn('sh', ['-c', command])
+        child.delimiter = b'END\\d'
+        # all of the output in the buffer at once
+        child.expect_exact(b'three')
+        child.buffer = child.before + child.after + child.buffer
+        self.assertEqual(child.readline(), b'one\r\n')
+        self.assertEqual(child.match.group(), b'\r\n')
+        self.assertEqual(child.readline(), b'two-')
+        self.assertEqual(child.match.group(), b'END7')
+        child.close()
+        child = pexpect.spawn('sh', ['-c', command])
+        child.delimiter = b'END\\d'
+        child.expect_exact(b'three')
+        child.buffer = child.before + child.after + child.buffer
+        it = iter(child)
+        self.assertEqual([next(it) for n in range(4)],
+                         [b'one\r\n', b'two-', b'\r\n', b'three\r\n'])
+        child.close()
+
     def test_write (self):
         child = pexpect.spawn('cat')
         child.write('a')
@@ -287,6 +349,56 @@ class TestCaseMisc(PexpectTestCase.PexpectTestCase):
             if os.path.exists(bin_dir):
                 os.rmdir(bin_dir)
 
+    def test_which_cache(self):
+        " spawn remembers where it found a command until PATH changes "
+        bin_dir = tempfile.mkdtemp()
+        bin_dir2 = tempfile.mkdtemp()
+        save_path = os.environ['PATH']
+        paths = [os.path.join(bin_dir, 'cmd'), os.path.join(bin_dir2, 'cmd')]
+        save_which = pexpect.which
+        try:
+            os.environ['PATH'] = os.pathsep.join([bin_dir, bin_dir2])
+            with open(paths[1], 'w') as fp:
+                fp.write('#!/bin/sh\n')
+            os.chmod(paths[1], 0o700)
+            pexpect.which_cache.clear()
+            self.assertEqual(pexpect._cached_which('cmd'), paths[1])
+            self.assertEqual(pexpect._cached_which('cmd'), paths[1])
+            self.assertEqual(pexpect.which_cache.hits, 1)
+
+            # A new command earlier in PATH is noticed.
+            with open(paths[0], 'w') as fp:
+                fp.write('#!/bin/sh\n')
+            os.chmod(paths[0], 0o700)
+            self.assertEqual(pexpect._cached_which('cmd'), paths[0])
+
+            # So is one that is no longer executable, and what is found
+            # instead is remembered.
+            os.chmod(paths[0], 0o600)
+            self.assertEqual(pexpect._cached_which('cmd'), paths[1])
+            hits = pexpect.which_cache.hits
+            self.assertEqual(pexpect._cached_which('cmd'), paths[1])
+            self.assertEqual(pexpect.which_cache.hits, hits + 1)
+
+            # A command that is not found is looked for once per call.
+            calls = []
+            def which(filename):
+                calls.append(filename)
+                return save_which(filename)
+            pexpect.which = which
+            os.chmod(paths[1], 0o600)
+            self.assertEqual(pexpect._cached_which('cmd'), None)
+            self.assertEqual(calls, ['cmd'])
+        finally:
+            pexpect.which = save_which
+            os.environ['PATH'] = save_path
+            pexpect.which_cache.clear()
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+            os.rmdir(bin_dir)
+            os.rmdir(bin_dir2)
+
     def test_which_should_not_match_folders(self):
         # make up a path and insert a folder, which is 'executable', which
         # a naive implementation might match (previously pexpect versions
@@ -362,6 +474,358 @@ class TestCaseMisc(PexpectTestCase.PexpectTestCase):
                '5: "other"\n    6: TIMEOUT')
         assert ss.__str__() == out, (ss.__str__(), out)
 
+    def test_searcher_re_combined(self):
+        patterns = [re.compile(p, re.DOTALL) for p in [
+            b'(\\d+) errors?', b'(?P<host>[a-z]+)#', b'--More--', b'(a)(b)?c']]
+        ss = pexpect.searcher_re(patterns, combine=True)
+        assert ss._combined is not None
+        for buf in [b'3 errors on router#', b'router# 3 errors', b'abc',
+                    b'--More--', b'nothing here', b'xxac 1 error']:
+            index = ss.search(buf, len(buf))
+            expected = pexpect.searcher_re(patterns)
+            self.assertEqual(index, expected.search(buf, len(buf)))
+            if index >= 0:
+                self.assertEqual((ss.start, ss.end), (expected.start,
+                                                      expected.end))
+                self.assertEqual(ss.match.groups(), expected.match.groups())
+                self.assertEqual(ss.match.groupdict(),
+                                 expected.match.groupdict())
+
+        # These are searched for one at a time.
+        for patterns in [[re.compile(b'(a)\\1'), re.compile(b'b')],
+                         [re.compile(b'(?i)a'), re.compile(b'b')],
+                         [re.compile(b'a', re.I), re.compile(b'b')]]:
+            ss = pexpect.searcher_re(patterns, combine=True)
+            assert ss._combined is None, patterns
+
+    def _search_chunks(self, ss, chunks, searchwindowsize=None):
+        # Feed 'chunks' to 'ss' the same way expect_loop() does.
+        buf = chunks[0][:0]
+        for chunk in chunks:
+            buf = buf + chunk
+            index = ss.search(buf, len(chunk), searchwindowsize)
+            if index >= 0:
+                return index, ss.start, ss.end
+        return -1
+
+    def test_searcher_string_automaton(self):
+        searcher_find = pexpect.searcher_string
+        class searcher_automaton(pexpect.searcher_string):
+            automaton_threshold = 8
+        strings = [b'error', b'err', b'rror: ', b'% Invalid', b'Invalid',
+                   b'denied', b'ied', b'fail', b'fai', b'failure']
+        assert searcher_find(strings)._automaton is None
+        assert searcher_automaton(strings)._automaton is not None
+        inputs = [
+            [b'no problems here'],
+            [b'an err', b'or: x'],
+            [b'an e', b'rr', b'or: x'],
+            [b'access de', b'nied'],
+            [b'% Inval', b'id input'],
+            [b'fa', b'ilure and failure'],
+            [b'xxxxxxxxx', b'xxxfai', b'l'],
+        ]
+        for chunks in inputs:
+            for window in (None, 3, 8):
+                expected = self._search_chunks(searcher_find(strings),
+                        chunks, window)
+                got = self._search_chunks(searcher_automaton(strings),
+                        chunks, window)
+                self.assertEqual(got, expected, (chunks, window))
+
+        # unicode strings, leftmost match wins, then the lowest index
+        strings = [u'b\xe9e', u'ab\xe9', u'ab', u'c', u'd', u'e', u'f', u'g']
+        ss = searcher_automaton(strings)
+        self.assertEqual(self._search_chunks(ss, [u'xa', u'b\xe9e']),
+                         (1, 1, 4))
+        # searching a new buffer starts over
+        self.assertEqual(self._search_chunks(ss, [u'xxg']), (7, 2, 3))
+
+    def test_searcher_re_searchstart(self):
+        class searcher_full(pexpect.searcher_re):
+            def _searchstarts(self, buffer, freshlen, windowstart):
+                return [windowstart] * len(self._searches)
+        patterns = [b'\\d+ errors?', b'[a-z]+#', b'--More--$', b'\\bok\\b',
+                    b'x(?=yz)', b'(a)(b)?c', b'\\S+> ', b'(?i)done\\.',
+                    b'.*END', b'(?s).*END', b'[^a]*a']
+        inputs = [
+            [b'3 err', b'ors'],
+            [b'rout', b'er', b'# '],
+            [b'--Mo', b're--'],
+            [b'book', b' ok', b'ay ok'],
+            [b'xxx', b'y', b'z'],
+            [b'a', b'bc'],
+            [b'foo bar', b'baz>', b' '],
+            [b'all DO', b'NE', b'.'],
+            [b'line\nmore', b' line E', b'ND'],
+            [b'bbbb', b'bbb', b'a'],
+        ]
+        for pattern in patterns:
+            pattern = re.compile(pattern)
+            for chunks in inputs:
+                for window in (None, 4):
+                    expected = self._search_chunks(searcher_full([pattern]),
+                            chunks, window)
+                    got = self._search_chunks(pexpect.searcher_re([pattern]),
+                            chunks, window)
+                    self.assertEqual(got, expected, (pattern.pattern, chunks,
+                                                     window))
+
+        reach = pexpect._pattern_reach(re.compile(b'\\w+#'))
+        self.assertEqual(reach[:2], (None, 0))
+        self.assertEqual(reach[2].match(b'a b# c d#', 0, 6).end(), 5)
+        self.assertEqual(pexpect._pattern_reach(re.compile(u'ab?(?=cd)')),
+                         (2, 2, None))
+        self.assertEqual(pexpect._pattern_reach(re.compile(u'(?s).*#'))[2],
+                         None)
+
+    def test_pattern_cache(self):
+        cache = pexpect.searcher_cache(maxsize=2)
+        made = []
+        def factory(value):
+            return lambda: made.append(value) or value
+        self.assertEqual(cache.get('a', factory(1)), 1)
+        self.assertEqual(cache.get('b', factory(2)), 2)
+        self.assertEqual(cache.get('a', factory(3)), 1)
+        # 'b' is the least recently used, so it goes first
+        self.assertEqual(cache.get('c', factory(4)), 4)
+        self.assertEqual(cache.get('b', factory(5)), 5)
+        self.assertEqual(made, [1, 2, 4, 5])
+        self.assertEqual(cache.info(),
+                         {'hits': 1, 'misses': 4, 'size': 2, 'maxsize': 2})
+        # unhashable keys and a zero size bypass the cache
+        self.assertEqual(cache.get(['x'], factory(6)), 6)
+        cache.maxsize = 0
+        self.assertEqual(cache.get('a', factory(7)), 7)
+        self.assertEqual(len(cache), 0)
+        cache.clear()
+        self.assertEqual(cache.info()['misses'], 0)
+
+        # searchers handed out from the cache do not share progress
+        class searcher_automaton(pexpect.searcher_string):
+            automaton_threshold = 8
+        proto = searcher_automaton([('x%d' % n).encode('ascii')
+                                    for n in range(10)])
+        first, second = proto.copy(), proto.copy()
+        self.assertEqual(first.search(b'aax', 3), -1)
+        self.assertEqual(second.search(b'x5', 2), 5)
+        self.assertEqual(first.search(b'aax1', 1), 1)
+        assert first._automaton._delta is second._automaton._delta
+
+    def test_expect_uses_pattern_cache(self):
+        pexpect.pattern_cache.clear()
+        p = pexpect.spawn('cat')
+        for n in range(3):
+            p.sendline('line %d' % n)
+            p.expect(['line \\d', 'never'])
+            p.expect_exact(['\r\n', 'never'])
+        info = pexpect.pattern_cache.info()
+        # two re.compile() and a searcher for each of expect() and
+        # expect_exact()
+        self.assertEqual(info['misses'], 4)
+        self.assertEqual(info['hits'], 8)
+        p.sendeof()
+
+    def test_read_arena(self):
+        class copying_spawn(pexpect.spawn):
+            def read_nonblocking(self, size=1, timeout=-1):
+                return pexpect.spawn.read_nonblocking(self, size, timeout)
+        log = io.BytesIO()
+        p = pexpect.spawn('seq 1 20000', maxread=256, logfile=log)
+        p.expect(pexpect.EOF)
+        # only the arena itself was allocated
+        self.assertEqual(p.read_allocations, 1)
+        self.assertEqual(log.getvalue(), p.before)
+        q = copying_spawn('seq 1 20000', maxread=256)
+        q.expect(pexpect.EOF)
+        self.assertEqual(q.before, p.before)
+        assert q.read_allocations > len(q.before) // 256, q.read_allocations
+
+        # without memoryview (Python 2.6) there is no arena either
+        pexpect._have_memoryview = False
+        try:
+            q = pexpect.spawn('seq 1 20000', maxread=256)
+            q.expect(pexpect.EOF)
+        finally:
+            pexpect._have_memoryview = True
+        self.assertEqual(q.before, p.before)
+        assert q._arena is None
+
+        buf = bytearray(4)
+        p = pexpect.spawn('echo', ['hello'])
+        self.assertEqual(p.read_nonblocking_into(buf), 4)
+        self.assertEqual(bytes(buf), b'hell')
+
+    def test_maxread_range(self):
+        p = pexpect.spawn('cat', maxread=100)
+        p.maxread_range = (256, 8192)
+        p.sendline('x')
+        p.expect('x\r\n')
+        # brought into range, then halved on small reads
+        self.assertEqual(p.maxread, 256)
+        p.sendline('y' * 3000)
+        p.expect('y{3000}\r\n')
+        p.expect('y{3000}\r\n')
+        assert p.maxread > 256, p.maxread
+        assert p.maxread <= 8192, p.maxread
+        for n in range(30):
+            p.sendline('z')
+            p.expect('z\r\n')
+        self.assertEqual(p.maxread, 256)
+        p.sendeof()
+
+    def test_drain_limit(self):
+        class counting_searcher(pexpect.searcher_string):
+            searches = 0
+            def search(self, buffer, freshlen, searchwindowsize=None):
+                counting_searcher.searches += 1
+                return pexpect.searcher_string.search(self, buffer, freshlen,
+                                                      searchwindowsize)
+        for spawn_class in (pexpect.spawn, pexpect.spawnu):
+            p = spawn_class('seq 1 100000', maxread=1024)
+            p.drain_limit = 1 << 20
+            expected = ''.join('%d\r\n' % n for n in range(1, 100001))
+            if spawn_class is pexpect.spawn:
+                expected = expected.encode('ascii')
+            counting_searcher.searches = 0
+            p.expect_loop(counting_searcher([pexpect.EOF]))
+            self.assertEqual(p.before, expected)
+            # far fewer searches than reads of maxread bytes
+            assert counting_searcher.searches < len(expected) // 1024 // 2
+        # child_fd is never made non-blocking, not even inside expect()
+        flags = []
+        class flags_searcher(pexpect.searcher_string):
+            def search(self, buffer, freshlen, searchwindowsize=None):
+                flags.append(fcntl.fcntl(p.child_fd, fcntl.F_GETFL))
+                return pexpect.searcher_string.search(self, buffer, freshlen,
+                                                      searchwindowsize)
+        p = pexpect.spawn('cat')
+        p.drain_limit = 4096
+        p.sendline('abc')
+        p.expect_loop(flags_searcher([b'abc']))
+        assert flags
+        self.assertEqual([f & os.O_NONBLOCK for f in flags], [0] * len(flags))
+        p.sendeof()
+
+    def test_pollers_high_fd(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard < 1200:
+            raise unittest.SkipTest('cannot open enough file descriptors')
+        resource.setrlimit(resource.RLIMIT_NOFILE, (1200, hard))
+        fds = []
+        try:
+            # push the child's pty past select()'s FD_SETSIZE
+            while len(fds) < 1100:
+                fds.append(os.open(os.devnull, os.O_RDONLY))
+            pollers = [pexpect.poll_poller]
+            if hasattr(select, 'epoll'):
+                pollers.append(pexpect.epoll_poller)
+            for poller_type in pollers:
+                p = pexpect.spawn('echo', ['hello'])
+                p.poller_type = poller_type
+                assert p.child_fd >= 1024, p.child_fd
+                p.expect('hello')
+                p.expect(pexpect.EOF)
+                p.close()
+        finally:
+            for fd in fds:
+                os.close(fd)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def test_pass_fds(self):
+        " only the descriptors in pass_fds are inherited by the child "
+        read_end, write_end = os.pipe()
+        other_read, other_write = os.pipe()
+        try:
+            script = ('import os\n'
+                      'os.write(%d, b"passed\\n")\n'
+                      'try:\n'
+                      '    os.write(%d, b"other\\n")\n'
+                      'except OSError:\n'
+                      '    print("closed")\n' % (write_end, other_write))
+            p = pexpect.spawn(sys.executable, ['-c', script],
+                              pass_fds=[write_end])
+            p.expect(pexpect.EOF)
+            assert b'closed' in p.before, p.before
+            os.close(write_end)
+            os.close(other_write)
+            self.assertEqual(os.read(read_end, 100), b'passed\n')
+            self.assertEqual(os.read(other_read, 100), b'')
+        finally:
+            for fd in (read_end, write_end, other_read, other_write):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+    def test_posix_spawn(self):
+        " the child can be started with posix_spawn instead of fork "
+        if not pexpect._can_posix_spawn:
+            return 'SKIP'
+        p = pexpect.spawn('sh', ['-c', 'stty size; pwd; cat'],
+                          cwd='/', use_posix_spawn=True)
+        assert p.use_posix_spawn
+        p.expect('24 80')
+        p.expect('/\r\n')
+        p.sendline('abc')
+        p.expect('abc')
+        # The pty is the controlling tty, so ^C interrupts the child.
+        p.sendintr()
+        p.expect(pexpect.EOF)
+        p.close()
+        self.assertEqual(p.signalstatus, signal.SIGINT)
+
+        # pass_fds reach the child, but stay non-inheritable here
+        r, w = os.pipe()
+        try:
+            p = pexpect.spawn(sys.executable,
+                              ['-c', 'import os, sys; '
+                               'os.write(int(sys.argv[1]), b"ok")', str(w)],
+                              pass_fds=[w], use_posix_spawn=True)
+            p.expect(pexpect.EOF)
+            self.assertEqual(os.read(r, 2), b'ok')
+            assert not os.get_inheritable(w)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_spawn_server(self):
+        " a spawn_server starts children and reports how they exit "
+        server = pexpect.spawn_server()
+        try:
+            p = pexpect.spawn('sh', ['-c', 'stty size; cat'],
+                              spawn_server=server)
+            p.expect('24 80')
+            p.sendline('abc')
+            p.expect('abc')
+            assert p.isalive()
+            p.sendintr()
+            p.expect(pexpect.EOF)
+            assert not p.isalive()
+            self.assertEqual(p.signalstatus, signal.SIGINT)
+
+            p = pexpect.spawnu('sh', ['-c', 'pwd; exit 3'], cwd='/',
+                               spawn_server=server)
+            p.expect('/\r\n')
+            self.assertEqual(p.wait(), 3)
+            p.close()
+
+            # A bad request gets an error back, and the server carries on.
+            with server._lock:
+                pexpect._send_fds(server._sock, b'not a pickle', [])
+                reply, fds = pexpect._recv_fds(server._sock, 4096, 2)
+            pid, error = pexpect.pickle.loads(reply)
+            assert pid is None and 'UnpicklingError' in error, error
+            self.assertRaises(pexpect.ExceptionPexpect, pexpect.spawn, 'cat',
+                              env={'BIG': 'x' * (1 << 18)},
+                              spawn_server=server)
+            p = pexpect.spawn('sh', ['-c', 'exit 4'], spawn_server=server)
+            self.assertEqual(p.wait(), 4)
+        finally:
+            server.close()
+        self.assertRaises(pexpect.ExceptionPexpect, pexpect.spawn, 'cat',
+                          spawn_server=server)
+
     def test_nonnative_pty_fork(self):
         class spawn_ourptyfork(pexpect.spawn):
             def _spawn(self, command, args=[]):
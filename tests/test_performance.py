@@ -27,6 +27,17 @@ from . import PexpectTestCase
 
 # This isn't exactly a unit test, but it fits in nicely with the rest of the tests.
 
+class polling_spawn(pexpect.spawn):
+    '''This reads the way pexpect used to, before reading was driven only by
+    the readiness of the pty: it asks isalive() (waitpid) before every read
+    and sleeps for 100us after every read. '''
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        self.isalive()
+        s = pexpect.spawn.read_nonblocking(self, size, timeout)
+        time.sleep(0.0001)
+        return s
+
 class PerformanceTestCase (PexpectTestCase.PexpectTestCase):
 
     '''Testing the performance of expect, with emphasis on wading through long
@@ -81,6 +92,76 @@ class PerformanceTestCase (PexpectTestCase.PexpectTestCase):
         e.sendline(('list(range(1, %d+1))' % n).encode('ascii'))
         self.assertEqual(e.expect([b'inquisition', '%d' % n]), 1)
 
+    def drain_seq(self, n, spawn_class, maxread):
+        e = spawn_class('seq 1 %d' % n, maxread=maxread)
+        self.assertEqual(e.expect([b'inquisition', pexpect.EOF]), 1)
+        assert e.before.endswith(('%d\r\n' % n).encode('ascii'))
+
+    def test_event_driven_reads(self):
+        '''Compare reading in small chunks with the old polling read path.
+        '''
+        print()
+        times = []
+        for spawn_class in (polling_spawn, pexpect.spawn):
+            start_time = time.time()
+            self.drain_seq(100000, spawn_class, 64)
+            times.append(time.time() - start_time)
+            print("100000 lines with %s:" % spawn_class.__name__, times[-1])
+        print("speedup of the event driven read path: %.1fx" %
+              (times[0] / times[1]))
+
+    def test_iter_lines(self):
+        '''Compare iterating over lines with expecting each newline.
+        '''
+        print()
+        e = pexpect.spawn('seq 1 100000', maxread=4096)
+        start_time = time.time()
+        n = 0
+        while e.expect([b'\r\n', pexpect.EOF]) == 0:
+            n += 1
+        expect_time = time.time() - start_time
+        self.assertEqual(n, 100000)
+        print("100000 lines with expect():", expect_time)
+        e = pexpect.spawn('seq 1 100000', maxread=4096)
+        start_time = time.time()
+        lines = list(e)
+        iter_time = time.time() - start_time
+        self.assertEqual(len(lines), 100000)
+        self.assertEqual(lines[-1], b'100000\r\n')
+        print("100000 lines with iter():", iter_time)
+        print("speedup of the line iterator: %.1fx" % (expect_time / iter_time))
+
+    def search_chunks(self, searcher, data, chunk=4096):
+        buf = b''
+        start_time = time.time()
+        for i in range(0, len(data), chunk):
+            buf = (buf + data[i:i + chunk])[-2 * chunk:]
+            self.assertEqual(searcher.search(buf, min(chunk, len(buf))), -1)
+        return time.time() - start_time
+
+    def test_searcher_string(self):
+        '''Compare find() with the Aho-Corasick automaton for many strings.
+        '''
+        class searcher_automaton(pexpect.searcher_string):
+            automaton_threshold = 8
+        print()
+        line = b'option_name = some value; enabled=true path=/etc/foo.conf\n'
+        data = line * (1024 * 1024 // len(line))
+        words = [b'error', b'fatal', b'panic', b'failed', b'denied',
+                 b'refused', b'timeout', b'abort', b'segfault', b'corrupt']
+        # The first characters of these are everywhere in the data ...
+        common = [w + s for w in words for s in (b': ', b'!', b' in ', b'.')]
+        # ... and those of these nowhere.
+        rare = [b'%' + w.upper() + s for w in words
+                for s in (b': ', b'!', b' in ', b'.')]
+        for name, strings in (('common', common), ('rare', rare)):
+            find_time = self.search_chunks(pexpect.searcher_string(strings),
+                                           data)
+            automaton_time = self.search_chunks(searcher_automaton(strings),
+                                                data)
+            print("40 strings, %s first characters: find() %.3f,"
+                  " automaton %.3f" % (name, find_time, automaton_time))
+
     def test_100000(self):
         if platform.python_implementation() == 'PyPy':
             raise unittest.SkipTest("This test fails on PyPy because of REPL differences")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+'''
+PEXPECT LICENSE
+
+    This license is approved by the OSI and FSF as GPL-compatible.
+        http://opensource.org/licenses/isc-license.txt
+
+    Copyright (c) 2012, Noah Spurrier <noah@noah.org>
+    PERMISSION TO USE, COPY, MODIFY, AND/OR DISTRIBUTE THIS SOFTWARE FOR ANY
+    PURPOSE WITH OR WITHOUT FEE IS HEREBY GRANTED, PROVIDED THAT THE ABOVE
+    COPYRIGHT NOTICE AND THIS PERMISSION NOTICE APPEAR IN ALL COPIES.
+    THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+    WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+    MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+    ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+    WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+    ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+    OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''
+import pexpect
+import unittest
+from . import PexpectTestCase
+import io
+
+def seq_output(n):
+    return b''.join(('%d\r\n' % i).encode('ascii') for i in range(1, n + 1))
+
+class SpillTestCase(PexpectTestCase.PexpectTestCase):
+
+    def test_spill_buffer(self):
+        b = pexpect.spill_buffer(b'abc', threshold=8)
+        b += b'defgh'
+        self.assertEqual(b.view(), b'abcdefgh')
+        assert isinstance(b.data, bytearray)
+        b += b'ijklmnop'
+        assert not isinstance(b.data, bytearray)
+        self.assertEqual(b.data[:], b'abcdefghijklmnop')
+        self.assertEqual(b.view(2, 6), b'cdef')
+        v = b.view(1)
+        assert isinstance(v, pexpect.spilled_output), v
+        self.assertEqual(len(v), 15)
+        self.assertEqual(v[0], ord('b'))
+        self.assertEqual(v[-1], ord('p'))
+        self.assertEqual(v[-3:], b'nop')
+        self.assertEqual(v.find(b'mn'), 11)
+        self.assertEqual(v.find(b'a'), -1)
+        self.assertEqual(b''.join(v.chunks(4)), b'bcdefghijklmnop')
+        # appending does not change what a view shows
+        b += b'qrstuvwxyz'
+        self.assertEqual(v.tobytes(), b'bcdefghijklmnop')
+        f = io.BytesIO()
+        b.view().write_to(f)
+        self.assertEqual(f.getvalue(), b'abcdefghijklmnopqrstuvwxyz')
+
+    def test_expect_spilled(self):
+        p = pexpect.spawn('seq 1 100000', maxread=65536)
+        p.spill_threshold = 10000
+        p.expect(b'\r\n50000\r\n')
+        assert isinstance(p.before, pexpect.spilled_output), p.before
+        self.assertEqual(p.before.tobytes(), seq_output(49999)[:-2])
+        p.expect(pexpect.EOF)
+        assert isinstance(p.before, pexpect.spilled_output), p.before
+        rest = seq_output(100000)[len(seq_output(50000)):]
+        self.assertEqual(p.before.tobytes(), rest)
+
+    def test_spawnu_not_spilled(self):
+        p = pexpect.spawnu('seq 1 10')
+        p.spill_threshold = 10
+        self.assertRaises(pexpect.ExceptionPexpect, p.expect, u'5')
+        p.close()
+
+    def test_timeout_then_iterate(self):
+        p = pexpect.spawn('sh', ['-c', 'seq 1 20000; sleep 1; echo DONE'],
+                          maxread=65536)
+        p.spill_threshold = 1000
+        self.assertEqual(p.expect([b'DONE', pexpect.TIMEOUT], timeout=0.5), 1)
+        assert isinstance(p.buffer, pexpect.spilled_output), p.buffer
+        lines = list(p)
+        self.assertEqual(b''.join(lines), seq_output(20000) + b'DONE\r\n')
+
+    def test_run_spilled(self):
+        result = pexpect.run('seq 1 20000', spill_threshold=1000)
+        assert isinstance(result, pexpect.spilled_output), result
+        self.assertEqual(result.tobytes(), seq_output(20000))
+
+if __name__ == '__main__':
+    unittest.main()
+
+suite = unittest.makeSuite(SpillTestCase,'test')
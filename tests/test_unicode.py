@@ -34,6 +34,15 @@ class UnicodeTests(PexpectTestCase.PexpectTestCase):
         p.sendeof()
         p.expect_exact (pexpect.EOF)
 
+    def test_read_exactly (self):
+        p = pexpect.spawnu('cat')
+        p.setecho(False)
+        p.sendline('þython ☃')
+        # counts characters, not bytes
+        self.assertEqual(p.read_exactly(8), 'þython ☃')
+        self.assertEqual(p.read(2), '\r\n')
+        p.sendeof()
+
     def test_expect_echo (self):
         '''This tests that echo can be turned on and off.
         '''